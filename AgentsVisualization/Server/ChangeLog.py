@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Per-step change sets of the warehouse simulation.
+
+Every step the model records which robots changed (moved, picked up or
+dropped a box) and which boxes were picked up. Clients that already know the
+state at some step only need the robots and boxes changed after it; clients
+that are further behind than the kept history need a full snapshot.
+The log is read by the server threads while the model records the next step,
+so both sides hold its lock.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import threading
+from collections import deque
+
+class ChangeLog:
+    """
+    Change sets of the last steps.
+    Attributes:
+        history: Number of steps with changes that are kept
+        steps: Deque of (step, robot unique_ids, {box unique_id: position}) for the steps with changes, oldest first
+        floor: Every change made after this step is still in the log
+        lock: Held while recording and while reading changes
+    """
+    def __init__(self, history = 256, step = 0):
+        self.history = history
+        self.steps = deque()
+        self.floor = step
+        self.lock = threading.Lock()
+
+    def record(self, step, robots = (), boxes = ()):
+        '''
+        Adds robots and picked up boxes to the change set of the step.
+        Args:
+            robots: unique_ids of the robots that changed
+            boxes: Dictionary from the unique_id of each picked up box to the cell it was taken from
+        '''
+        with self.lock:
+            if not self.steps or self.steps[-1][0] != step:
+                self.steps.append((step, set(), {}))
+                while len(self.steps) > self.history:
+                    self.floor = self.steps.popleft()[0]
+            _, changed_robots, picked_boxes = self.steps[-1]
+            changed_robots.update(robots)
+            picked_boxes.update(boxes)
+
+    def changed_since(self, step, current):
+        '''
+        Returns the (robot unique_ids, {box unique_id: position}) changed after step and up
+        to current, or None if the log can't tell (step older than the history or newer than current).
+        '''
+        with self.lock:
+            if step < self.floor or step > current:
+                return None
+            robots, boxes = set(), {}
+            for changed_step, changed_robots, picked_boxes in reversed(self.steps):
+                if changed_step <= step:
+                    break
+                if changed_step <= current:
+                    robots |= changed_robots
+                    boxes.update(picked_boxes)
+            return robots, boxes
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Windowed cooperative A* for the warehouse robots.
+
+Every robot plans its next `window` moves with a space-time A* search that
+avoids the cells (and swaps) already reserved by the other robots, then
+reserves the cells of its plan. Robots follow their plan and only plan again
+when it runs out, when their goal changes (a box was picked up or dropped) or
+when a reservation breaks because the next cell is not free. The reservation
+table lives in the planner and is kept between steps; only the past entries
+are pruned. Robots that have been waiting for `patience` steps drop their plan
+and take a random free cell, and robots with nothing to do move away from the
+drop zone, so the robots around it can't lock each other in.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import heapq
+from collections import deque
+from RobotAgents import DistanceField, EMPTY, ROBOT, UNREACHABLE
+
+class CooperativePlanner:
+    """
+    Shared space-time reservation table and per-robot plans.
+    Attributes:
+        window: Number of future steps each robot plans and reserves
+        cells: Dictionary from time to a dictionary from cell to the unique_id of the robot that reserved it
+        edges: Dictionary from time to a dictionary from (from_cell, to_cell) to the robot moving through it
+        plans: Dictionary from robot unique_id to a deque of (time, cell) still to walk
+        goals: Dictionary from robot unique_id to the (has_box, target) the plan was made for
+        waits: Dictionary from robot unique_id to the number of steps it has been waiting in place
+        backing_off: Dictionary from robot unique_id to the steps it still has to spend giving way
+        box_distances: Dictionary from box unique_id to the distance array used as heuristic to reach it
+    """
+    def __init__(self, model, window = 8, patience = 2):
+        self.model = model
+        self.window = window
+        self.patience = patience
+        self.cells = {}
+        self.edges = {}
+        self.plans = {}
+        self.goals = {}
+        self.waits = {}
+        self.backing_off = {}
+        self.box_distances = {}
+        self.oldest = 0
+
+    def next_cell(self, robot, empty_positions):
+        '''
+        Returns the cell the robot moves to this step, or None to wait.
+        Args:
+            robot: RobotAgent that is taking its turn
+            empty_positions: Free neighbour cells of the robot
+        '''
+        now = self.model.cant_steps
+        self.prune(now)
+
+        if not robot.has_box:
+            robot.update_target()
+
+        plan = self.plans.get(robot.unique_id)
+        while plan and plan[0][0] <= now:
+            plan.popleft()
+        if plan and self.goals[robot.unique_id] != (robot.has_box, robot.target):
+            # The robot picked up or dropped a box, or lost its target
+            self.release(robot)
+            plan = None
+        if plan and not self.is_valid(robot, plan, empty_positions):
+            # Reservation broken
+            self.release(robot)
+            plan = None
+
+        waits = self.waits.get(robot.unique_id, 0)
+        if waits >= self.patience:
+            # Stuck for too long: give way for a few steps instead of waiting for the plan
+            self.release(robot)
+            self.backing_off[robot.unique_id] = self.patience
+            plan = None
+        elif self.backing_off.get(robot.unique_id, 0) > 0:
+            self.backing_off[robot.unique_id] -= 1
+            plan = None
+        elif not plan:
+            plan = self.plan(robot, now)
+
+        if plan:
+            _, cell = plan.popleft()
+            cell = None if cell == robot.pos else cell
+        else:
+            # Nothing to plan for: free cell that nobody reserved
+            free = [cell for cell in empty_positions if self.cells.get(now + 1, {}).get(cell) is None]
+            cell = None
+            if free and (robot.has_box or robot.target is None):
+                # Back away from the drop zone: idle robots get out of the way
+                # and stuck robots make room for the ones in front of them
+                distances = self.model.drop_distances
+                cell = max(free, key = lambda cell: distances[cell] if distances[cell] != UNREACHABLE else -1)
+            elif free:
+                cell = self.model.random.choice(free)
+
+        self.waits[robot.unique_id] = 0 if cell is not None else waits + 1
+        return cell
+
+    def is_valid(self, robot, plan, empty_positions):
+        '''A plan is still valid if its next cell is the current one or a free neighbour.'''
+        cell = plan[0][1]
+        return cell == robot.pos or cell in empty_positions
+
+    def plan(self, robot, now):
+        '''Runs the space-time search for the robot and reserves the resulting plan.'''
+        # True distances (ignoring robots) are used as heuristic, so the
+        # window never leads the robot into a dead end
+        if robot.has_box:
+            distances = self.model.drop_fields[robot.zone].distances
+        else:
+            if robot.target is None:
+                return None
+            distances = self.distances_to(robot.target)
+        if distances[robot.pos] == UNREACHABLE:
+            return None
+        heuristic = lambda cell: int(distances[cell]) - 1
+
+        path = self.search(robot, now, heuristic)
+        if path is None:
+            return None
+        plan = deque((now + offset + 1, cell) for offset, cell in enumerate(path))
+        self.reserve(robot, plan)
+        self.plans[robot.unique_id] = plan
+        self.goals[robot.unique_id] = (robot.has_box, robot.target)
+        return plan
+
+    def distances_to(self, box):
+        '''Distance array to the box, computed the first time a robot heads to it.'''
+        distances = self.box_distances.get(box.unique_id)
+        if distances is None:
+            if len(self.box_distances) > len(self.model.box_index.claims):
+                # Forget the boxes nobody is chasing anymore
+                claimed = self.model.box_index.claims
+                self.box_distances = {box_id: d for box_id, d in self.box_distances.items() if box_id in claimed}
+            distances = DistanceField(self.model.grid, [box.pos]).distances
+            self.box_distances[box.unique_id] = distances
+        return distances
+
+    def search(self, robot, now, heuristic):
+        '''
+        Space-time A* from the robot position, limited to the window.
+        The search stops at the goal (heuristic 0) or at the window edge;
+        the cells of the remaining window are filled with waits.
+        Returns the cells for times now + 1 .. now + window, or None.
+        '''
+        grid = self.model.grid
+        cells = grid.cells
+        start = robot.pos
+        robot_id = robot.unique_id
+        counter = 0
+        heap = [(heuristic(start), 0, counter, start)]
+        parents = {(start, 0): None}
+        while heap:
+            _, g, _, cell = heapq.heappop(heap)
+            if g == self.window or heuristic(cell) == 0:
+                path = []
+                state = (cell, g)
+                while state[1] > 0:
+                    path.append(state[0])
+                    state = parents[state]
+                path.reverse()
+                path += [cell] * (self.window - g)
+                return path
+            time = now + g + 1
+            reserved = self.cells.get(time, {})
+            crossed = self.edges.get(time, {})
+            for neighbor in grid.get_neighborhood(cell, moore = False, include_center = True):
+                if (neighbor, g + 1) in parents:
+                    continue
+                state = cells[neighbor]
+                # Other robots may have moved away later on, but the first move needs a free cell
+                if neighbor != start and state != EMPTY and (state != ROBOT or g == 0):
+                    continue
+                if reserved.get(neighbor, robot_id) != robot_id:
+                    continue
+                if crossed.get((neighbor, cell), robot_id) != robot_id:
+                    continue
+                h = heuristic(neighbor)
+                if h < 0 or h >= UNREACHABLE - 1:
+                    continue
+                parents[(neighbor, g + 1)] = (cell, g)
+                counter += 1
+                heapq.heappush(heap, (g + 1 + h, g + 1, counter, neighbor))
+        return None
+
+    def reserve(self, robot, plan):
+        previous = robot.pos
+        for time, cell in plan:
+            self.cells.setdefault(time, {})[cell] = robot.unique_id
+            if cell != previous:
+                self.edges.setdefault(time, {})[(previous, cell)] = robot.unique_id
+            previous = cell
+
+    def release(self, robot):
+        '''Removes every reservation of the robot.'''
+        plan = self.plans.pop(robot.unique_id, None)
+        if not plan:
+            return
+        previous = robot.pos
+        for time, cell in plan:
+            reserved = self.cells.get(time)
+            if reserved is not None and reserved.get(cell) == robot.unique_id:
+                del reserved[cell]
+            crossed = self.edges.get(time)
+            if crossed is not None and crossed.get((previous, cell)) == robot.unique_id:
+                del crossed[(previous, cell)]
+            previous = cell
+
+    def prune(self, now):
+        '''Drops the reservations of the steps that already happened.'''
+        while self.oldest <= now:
+            self.cells.pop(self.oldest, None)
+            self.edges.pop(self.oldest, None)
+            self.oldest += 1
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Binary event journal for the warehouse simulation.
+
+Robots record typed events (move, pickup, drop, blocked) into a fixed size
+NumPy ring buffer. When the journal has a path the buffer is flushed to it in
+batches; otherwise it keeps the latest events in memory. Nothing is formatted
+unless verbose is turned on, which can be done at any time.
+
+File format: the 4 byte magic b"WHJ1" followed by packed little-endian
+records of 13 bytes (uint32 step, uint8 kind, int32 agent, int16 x, int16 y).
+
+Usage:
+    python EventJournal.py journal.bin            Summary of the journal
+    python EventJournal.py journal.bin --replay   Print every event
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import argparse
+import os
+import numpy as np
+
+MOVE, PICKUP, DROP, BLOCKED = range(4)
+EVENT_NAMES = ["move", "pickup", "drop", "blocked"]
+
+MAGIC = b"WHJ1"
+RECORD = np.dtype([("step", "<u4"), ("kind", "u1"), ("agent", "<i4"), ("x", "<i2"), ("y", "<i2")])
+
+class EventJournal:
+    """
+    Ring buffer of simulation events.
+    Attributes:
+        path: File the events are flushed to, None to keep them only in memory
+        verbose: If True every event is also printed as it is recorded
+        overwritten: Events lost because the in-memory ring was full
+    """
+    def __init__(self, path = None, capacity = 65536, verbose = False):
+        self.path = path
+        self.verbose = verbose
+        self.buffer = np.zeros(capacity, dtype = RECORD)
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+        self.overwritten = 0
+        self.file = None
+
+    def record(self, step, kind, agent, x, y):
+        '''Stores a single event.'''
+        if self.verbose:
+            print(describe(step, kind, agent, x, y))
+        self.buffer[self.head] = (step, kind, agent, x, y)
+        self.advance(1)
+
+    def record_many(self, step, kind, agents, xs, ys):
+        '''Stores one event per agent, all of the same kind and step.'''
+        agents = np.asarray(agents)
+        if self.verbose:
+            for agent, x, y in zip(agents.tolist(), np.asarray(xs).tolist(), np.asarray(ys).tolist()):
+                print(describe(step, kind, agent, x, y))
+        start = 0
+        while start < len(agents):
+            amount = min(len(agents) - start, self.capacity - self.head)
+            chunk = self.buffer[self.head:self.head + amount]
+            chunk["step"] = step
+            chunk["kind"] = kind
+            chunk["agent"] = agents[start:start + amount]
+            chunk["x"] = xs[start:start + amount]
+            chunk["y"] = ys[start:start + amount]
+            self.advance(amount)
+            start += amount
+
+    def advance(self, amount):
+        self.overwritten += max(0, self.count + amount - self.capacity)
+        self.count = min(self.count + amount, self.capacity)
+        self.head += amount
+        if self.head == self.capacity:
+            if self.path is not None:
+                self.flush()
+            else:
+                self.head = 0
+
+    def events(self):
+        '''Returns the buffered events, oldest first.'''
+        if self.count < self.capacity:
+            return self.buffer[:self.head].copy()
+        return np.concatenate((self.buffer[self.head:], self.buffer[:self.head]))
+
+    def flush(self):
+        '''Appends the buffered events to the journal file and empties the buffer.'''
+        if self.path is None:
+            return
+        if self.file is None:
+            new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self.file = open(self.path, "ab")
+            if new_file:
+                self.file.write(MAGIC)
+        self.file.write(self.events().tobytes())
+        self.file.flush()
+        self.head = 0
+        self.count = 0
+
+    def clear(self):
+        '''Forgets the buffered events without writing them, so the journal can be reused.'''
+        self.head = 0
+        self.count = 0
+        self.overwritten = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def describe(step, kind, agent, x, y):
+    '''Human readable line for an event.'''
+    if kind == MOVE:
+        return f"[{step}] El agente {agent} se mueve a ({x}, {y})"
+    elif kind == PICKUP:
+        return f"[{step}] El agente {agent} recoge la caja en ({x}, {y})"
+    elif kind == DROP:
+        return f"[{step}] El agente {agent} deja la caja en ({x}, {y})"
+    return f"[{step}] El agente {agent} no se puede mover de ({x}, {y}). No hay celdas vacias"
+
+def read_journal(path):
+    '''Loads every event of a journal file into a structured array.'''
+    with open(path, "rb") as journal_file:
+        if journal_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an event journal")
+        return np.frombuffer(journal_file.read(), dtype = RECORD)
+
+def summarize(events):
+    '''Returns a dictionary with the number of events of each kind and the steps covered.'''
+    counts = np.bincount(events["kind"], minlength = len(EVENT_NAMES))
+    summary = {name: int(count) for name, count in zip(EVENT_NAMES, counts)}
+    summary["events"] = len(events)
+    summary["agents"] = len(np.unique(events["agent"]))
+    summary["first_step"] = int(events["step"].min()) if len(events) else None
+    summary["last_step"] = int(events["step"].max()) if len(events) else None
+    return summary
+
+def replay(events):
+    '''Prints the events in the order they were recorded.'''
+    for event in events:
+        print(describe(int(event["step"]), int(event["kind"]), int(event["agent"]), int(event["x"]), int(event["y"])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Summarize or replay a warehouse event journal.")
+    parser.add_argument("path")
+    parser.add_argument("--replay", action = "store_true", help = "print every event")
+    args = parser.parse_args()
+
+    events = read_journal(args.path)
+    if args.replay:
+        replay(events)
+    else:
+        for key, value in summarize(events).items():
+            print(f"{key}: {value}")
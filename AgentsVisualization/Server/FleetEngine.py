@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized step engine for the warehouse robots.
+
+Holds every robot position and has_box flag in NumPy arrays and decides the
+move of the whole fleet in one batched pass over the occupancy array of the
+WarehouseGrid. Conflicts (two robots going to the same cell or picking up the
+same box) are resolved deterministically: robots carrying a box go first, then
+the lowest unique_id.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import numpy as np
+from RobotAgents import EMPTY, BOX, ROBOT, UNREACHABLE
+from EventJournal import MOVE, PICKUP, DROP, BLOCKED
+from Profiler import profiler
+
+# Von Neumann neighbourhood, in the same order as mesa's get_neighborhood
+OFFSETS_X = np.array([-1, 0, 0, 1])
+OFFSETS_Y = np.array([0, -1, 1, 0])
+
+class FleetEngine:
+    """
+    Steps every robot of a RobotModel at once.
+    Attributes:
+        robots: RobotAgent objects, sorted by unique_id
+        x, y: Positions of the robots
+        has_box: Boolean array, True for the robots carrying a box
+        zone: Index of the drop zone assigned to each loaded robot, -1 for the empty ones
+        box_field: DistanceField to the boxes still on the floor, followed by empty robots
+        rounds: Times the robots that lost their cell in a step try again with the cells freed since
+    """
+    def __init__(self, model, rounds = 3):
+        self.model = model
+        self.rounds = rounds
+        self.robots = list(model.grid.registries["robot"].values())
+        self.x = np.array([a.pos[0] for a in self.robots], dtype = np.int64)
+        self.y = np.array([a.pos[1] for a in self.robots], dtype = np.int64)
+        self.has_box = np.array([a.has_box for a in self.robots], dtype = bool)
+        self.ids = np.array([a.unique_id for a in self.robots], dtype = np.int64)
+        self.zone = np.array([a.zone if a.zone is not None else -1 for a in self.robots], dtype = np.int64)
+        self.zone_x = np.array([zone[0] for zone in model.drop_zones])
+        self.zone_y = np.array([zone[1] for zone in model.drop_zones])
+        self.rng = np.random.default_rng(model.random.getrandbits(64))
+
+        self.box_field = model.box_distance_field()
+
+    def step(self):
+        '''Advance every robot one step.'''
+        model = self.model
+        cells = model.grid.cells
+        x, y, has_box = self.x, self.y, self.has_box
+
+        phase = profiler.clock()
+        neighbor_x = x[:, None] + OFFSETS_X
+        neighbor_y = y[:, None] + OFFSETS_Y
+        states = cells[neighbor_x, neighbor_y]
+        phase = profiler.mark("FleetEngine.contents", phase)
+
+        # Leave box
+        drop_x, drop_y = self.zone_x[self.zone], self.zone_y[self.zone]
+        dropping = has_box & (np.abs(x - drop_x) + np.abs(y - drop_y) == 1)
+        model.boxes_dropped += int(dropping.sum())
+
+        # Pick up box, the lowest unique_id wins when several robots reach for the same one
+        box_side = states == BOX
+        reaching = ~has_box & box_side.any(axis = 1)
+        reaching_index = np.nonzero(reaching)[0]
+        direction = box_side[reaching_index].argmax(axis = 1)
+        box_cells = (neighbor_x[reaching_index, direction] * cells.shape[1] +
+                     neighbor_y[reaching_index, direction])
+        _, first_box = np.unique(box_cells, return_index = True)
+        picking = reaching_index[first_box]
+        picked_boxes = self.pick_up(neighbor_x[picking, direction[first_box]], neighbor_y[picking, direction[first_box]])
+        phase = profiler.mark("FleetEngine.drop_and_pickup", phase)
+
+        # Move: loaded robots follow the drop zone field, empty ones the box field
+        values = self.box_field.distances[neighbor_x, neighbor_y].astype(np.float64)
+        for zone, field in enumerate(model.drop_fields):
+            loaded = has_box & (self.zone == zone)
+            values[loaded] = field.distances[neighbor_x[loaded], neighbor_y[loaded]]
+        values[values == UNREACHABLE] = np.inf
+        # Random fraction to break ties; robots with no path take a random free cell
+        noise = self.rng.random(values.shape)
+        no_path = np.isinf(values.min(axis = 1))
+        keys = np.where(no_path[:, None], noise, values + noise)
+        phase = profiler.mark("FleetEngine.distances", phase)
+
+        # Robots that lose a cell try again with the cells freed by the winners,
+        # like the ones that take their turn later in the sequential scheduler
+        waiting = ~(dropping | reaching)
+        moved = []
+        for _ in range(self.rounds):
+            free = cells[neighbor_x, neighbor_y] == EMPTY
+            moving_index = np.nonzero(waiting & free.any(axis = 1))[0]
+            if not moving_index.size:
+                break
+            choice = np.where(free[moving_index], keys[moving_index], np.inf).argmin(axis = 1)
+            target_x = neighbor_x[moving_index, choice]
+            target_y = neighbor_y[moving_index, choice]
+
+            # Only one robot gets each cell: loaded robots first, then the lowest unique_id
+            priority = np.lexsort((moving_index, ~has_box[moving_index]))
+            moving_index, target_x, target_y = moving_index[priority], target_x[priority], target_y[priority]
+            _, first = np.unique(target_x * cells.shape[1] + target_y, return_index = True)
+            round_winners = moving_index[first]
+            self.move(round_winners, target_x[first], target_y[first])
+            waiting[round_winners] = False
+            moved.append(round_winners)
+        winners = np.concatenate(moved) if moved else np.zeros(0, dtype = np.int64)
+        phase = profiler.mark("FleetEngine.move", phase)
+
+        journal = model.journal
+        step = model.cant_steps
+        dropping_index = np.nonzero(dropping)[0]
+        journal.record_many(step, DROP, self.ids[dropping_index], drop_x[dropping_index], drop_y[dropping_index])
+        journal.record_many(step, PICKUP, self.ids[picking],
+                            neighbor_x[picking, direction[first_box]], neighbor_y[picking, direction[first_box]])
+        journal.record_many(step, MOVE, self.ids[winners], self.x[winners], self.y[winners])
+        blocked_index = np.nonzero(waiting)[0]
+        journal.record_many(step, BLOCKED, self.ids[blocked_index], x[blocked_index], y[blocked_index])
+        model.changes.record(step + 1, robots = self.ids[np.concatenate((dropping_index, picking, winners))].tolist(),
+                             boxes = picked_boxes)
+
+        has_box[dropping] = False
+        has_box[picking] = True
+        for index in np.nonzero(dropping)[0]:
+            model.release_drop_zone(self.zone[index])
+            self.zone[index] = -1
+            self.robots[index].has_box = False
+            self.robots[index].zone = None
+        for index in picking:
+            self.zone[index] = model.assign_drop_zone((int(self.x[index]), int(self.y[index])))
+            self.robots[index].has_box = True
+            self.robots[index].zone = int(self.zone[index])
+        profiler.mark("FleetEngine.bookkeeping", phase)
+
+    def pick_up(self, box_x, box_y):
+        '''
+        Removes the picked boxes from the grid, updates the distance fields and
+        returns a dictionary from the unique_id of each box to its cell.
+        '''
+        model = self.model
+        if not box_x.size:
+            return {}
+        picked_boxes = {}
+        for pos in zip(box_x.tolist(), box_y.tolist()):
+            box = model.grid[pos[0]][pos[1]]
+            picked_boxes[box.unique_id] = model.remove_box(box)
+        self.box_field.rebuild()
+        return picked_boxes
+
+    def move(self, index, new_x, new_y):
+        '''Moves the robots in the arrays, the occupancy array and the mesa grid.'''
+        model = self.model
+        grid = model.grid
+        cells = grid.cells
+        old_x, old_y = self.x[index], self.y[index]
+        cells[old_x, old_y] = EMPTY
+        cells[new_x, new_y] = ROBOT
+        self.x[index] = new_x
+        self.y[index] = new_y
+        model.total_moves += len(index)
+
+        # Keep the agent view the server reads in sync
+        for i, ox, oy, nx, ny in zip(index.tolist(), old_x.tolist(), old_y.tolist(), new_x.tolist(), new_y.tolist()):
+            robot = self.robots[i]
+            grid.grid[ox][oy] = None
+            grid.grid[nx][ny] = robot
+            grid.empties.add((ox, oy))
+            grid.empties.discard((nx, ny))
+            robot.pos = (nx, ny)
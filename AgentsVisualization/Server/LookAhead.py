@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Background look-ahead stepping.
+
+A LookAhead worker steps its model in a background thread ahead of the client
+and keeps the ModelView after every step in a bounded frame buffer. The
+server hands out the buffered frames in order, so a request doesn't wait for
+a step to run; the worker only stops when the buffer is full, and the time the
+client spends between requests is used to fill it again.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import threading
+from collections import deque
+from ModelView import ModelView
+
+class LookAhead:
+    """
+    Worker thread plus the bounded buffer of the frames it computed.
+    Attributes:
+        model: RobotModel stepped by the worker; nothing else may read or step it while the worker runs
+        capacity: Most frames computed ahead of the client
+        frames: Deque of the ModelViews not handed out yet, oldest first
+        last: Last ModelView handed out, the state the client has
+        stopped: True once the worker was stopped
+    """
+    def __init__(self, model, capacity = 16, current_step = 0):
+        self.model = model
+        self.capacity = capacity
+        self.frames = deque()
+        self.last = ModelView(model, current_step, {})
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        model = self.model
+        current_step = self.last.current_step
+        while True:
+            with self.condition:
+                while len(self.frames) >= self.capacity and not self.stopped:
+                    self.condition.wait()
+                if self.stopped or not model.running:
+                    return
+            step = model.cant_steps
+            model.step()
+            current_step += 1
+            changed = model.changes.changed_since(step, model.cant_steps)
+            frame = ModelView(model, current_step, changed[1] if changed is not None else None)
+            with self.condition:
+                self.frames.append(frame)
+                self.condition.notify_all()
+
+    def next_frame(self):
+        '''Hands out the next frame, waiting for the worker if the buffer is empty; None once the model is done.'''
+        with self.condition:
+            while not self.frames and not self.stopped and self.thread.is_alive():
+                self.condition.wait(0.1)
+            if not self.frames:
+                return None
+            self.last = self.frames.popleft()
+            self.condition.notify_all()
+            return self.last
+
+    def stop(self):
+        '''Stops the worker and drops the buffered frames.'''
+        with self.condition:
+            self.stopped = True
+            self.frames.clear()
+            self.condition.notify_all()
+        self.thread.join()
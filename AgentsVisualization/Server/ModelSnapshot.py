@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary snapshots of a RobotModel.
+
+Instead of pickling the mesa object graph, a snapshot keeps only what can't be
+recomputed: the counters, the random number generator states, and packed
+arrays with the drop zones, shelves, boxes, robots, robot paths and box
+claims. The border is rebuilt from the size of the grid and the distance
+fields from the occupancy array, so restoring a model is mostly array work.
+
+File format: the 4 byte magic b"WHS1", a HEADER record, the Python random
+state (625 uint32) and the fleet random state (6 uint64; with the
+simultaneous scheduler only the first one, its tie break seed, and with the
+sharded engine the seed and the tile columns and rows), followed by the
+arrays, whose lengths are stored in the header. Every integer is little-endian.
+
+The cooperative planner keeps no reservations across a snapshot; restored
+robots plan again on their next step.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import random
+import numpy as np
+from mesa import Model
+from mesa.time import BaseScheduler
+from RobotAgents import RobotAgent, ObstacleAgent, WarehouseGrid, BoxIndex, EMPTY, SHELF, BOX, ROBOT
+from EventJournal import EventJournal
+from ChangeLog import ChangeLog
+
+MAGIC = b"WHS1"
+ENGINES = ["agents", "vectorized", "simultaneous", "sharded"]
+PLANNERS = [None, "cooperative"]
+
+HEADER = np.dtype([("width", "<i4"), ("height", "<i4"), ("num_agents", "<i4"), ("shelves", "<i4"),
+                   ("num_boxes", "<i4"), ("max_moves", "<i8"), ("cant_steps", "<i8"), ("schedule_steps", "<i8"),
+                   ("boxes_dropped", "<i8"), ("total_moves", "<i8"), ("running", "u1"), ("engine", "u1"),
+                   ("planner", "u1"), ("window", "<i4"), ("queue_weight", "<f8"), ("drop_zones", "<i4"),
+                   ("claims", "<i4"), ("path_cells", "<i8"), ("random_version", "<i4"), ("gauss_next", "<f8")])
+ROBOT_RECORD = np.dtype([("id", "<i4"), ("x", "<i2"), ("y", "<i2"), ("has_box", "u1"), ("zone", "<i2"),
+                         ("target", "<i4"), ("path_length", "<u4")])
+POSITION = np.dtype([("x", "<i2"), ("y", "<i2")])
+CLAIM = np.dtype([("box", "<i4"), ("robot", "<i4")])
+
+def save_model(model, path):
+    '''Writes the snapshot of the model to path.'''
+    if model.engine == "sharded":
+        # The robots live in the shared arrays of the workers
+        model.fleet.sync()
+    registries = model.grid.registries
+    robots = list(registries["robot"].values())
+    shelves = list(registries["shelf"].values())
+
+    # Boxes that were picked up are not on the grid anymore and keep the position (-1, -1)
+    boxes = np.full(model.num_boxes, -1, dtype = POSITION)
+    for box in registries["box"].values():
+        boxes[box.unique_id] = box.pos
+
+    robot_records = np.zeros(len(robots), dtype = ROBOT_RECORD)
+    robot_records["id"] = [robot.unique_id for robot in robots]
+    robot_records["x"] = [robot.pos[0] for robot in robots]
+    robot_records["y"] = [robot.pos[1] for robot in robots]
+    robot_records["has_box"] = [robot.has_box for robot in robots]
+    robot_records["zone"] = [robot.zone if robot.zone is not None else -1 for robot in robots]
+    robot_records["target"] = [robot.target.unique_id if robot.target is not None else -1 for robot in robots]
+    robot_records["path_length"] = [len(robot.path) for robot in robots]
+    paths = np.array([cell for robot in robots for cell in robot.path], dtype = POSITION)
+
+    claims = np.array(list(model.box_index.claims.items()), dtype = CLAIM)
+
+    version, random_state, gauss_next = model.random.getstate()
+    header = np.zeros(1, dtype = HEADER)
+    header[0] = (model.grid.width, model.grid.height, model.num_agents, len(shelves), model.num_boxes,
+                 model.max_moves, model.cant_steps, model.schedule.steps, model.boxes_dropped, model.total_moves,
+                 model.running, ENGINES.index(model.engine),
+                 PLANNERS.index("cooperative" if model.planner is not None else None), model.window,
+                 model.queue_weight, len(model.drop_zones), len(claims), len(paths), version,
+                 gauss_next if gauss_next is not None else np.nan)
+
+    fleet_state = np.zeros(6, dtype = "<u8")
+    if model.engine == "vectorized":
+        state = model.fleet.rng.bit_generator.state
+        fleet_state[:] = (state["state"]["state"] >> 64, state["state"]["state"] & (2**64 - 1),
+                          state["state"]["inc"] >> 64, state["state"]["inc"] & (2**64 - 1),
+                          state["has_uint32"], state["uinteger"])
+    elif model.engine == "simultaneous":
+        fleet_state[0] = model.schedule.seed
+    elif model.engine == "sharded":
+        fleet_state[:3] = (model.fleet.seed,) + model.fleet.tiles
+
+    with open(path, "wb") as snapshot:
+        snapshot.write(MAGIC)
+        for array in (header, np.array(random_state, dtype = "<u4"), fleet_state,
+                      np.array(model.drop_zones, dtype = "<i2"),
+                      np.array([shelf.pos for shelf in shelves], dtype = POSITION),
+                      boxes, robot_records, paths, claims):
+            snapshot.write(array.tobytes())
+
+def load_model(cls, path, journal = None):
+    '''Builds a RobotModel (or subclass cls) from a snapshot written by save_model.'''
+    with open(path, "rb") as snapshot:
+        data = snapshot.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a model snapshot")
+    offset = len(MAGIC)
+
+    def take(dtype, count):
+        nonlocal offset
+        array = np.frombuffer(data, dtype = dtype, count = count, offset = offset)
+        offset += array.nbytes
+        return array
+
+    header = take(HEADER, 1)[0]
+    random_state = take("<u4", 625)
+    fleet_state = take("<u8", 6)
+    drop_zones = take("<i2", 2 * int(header["drop_zones"])).reshape(-1, 2)
+    shelves = take(POSITION, int(header["shelves"]))
+    boxes = take(POSITION, int(header["num_boxes"]))
+    robot_records = take(ROBOT_RECORD, int(header["num_agents"]))
+    paths = take(POSITION, int(header["path_cells"]))
+    claims = take(CLAIM, int(header["claims"]))
+
+    width, height = int(header["width"]), int(header["height"])
+    # Model.__new__ would replace the random generator shared through the
+    # class by every model, so the restored one gets its own instead
+    model = object.__new__(cls)
+    Model.__init__(model)
+    model.random = random.Random()
+    model.num_agents = int(header["num_agents"])
+    model.shelves = int(header["shelves"])
+    model.num_boxes = int(header["num_boxes"])
+    model.grid = WarehouseGrid(width, height, torus = False)
+    model.schedule = BaseScheduler(model)
+    model.schedule.steps = model.schedule.time = int(header["schedule_steps"])
+    model.running = bool(header["running"])
+    model.drop_zones = [tuple(zone) for zone in drop_zones.tolist()]
+    model.drop_zone = model.drop_zones[0]
+    model.queue_weight = float(header["queue_weight"])
+    if model.queue_weight.is_integer():
+        model.queue_weight = int(model.queue_weight)
+    model.boxes_dropped = int(header["boxes_dropped"])
+    model.cant_steps = int(header["cant_steps"])
+    model.total_moves = int(header["total_moves"])
+    model.max_moves = int(header["max_moves"])
+    model.journal = journal if journal is not None else EventJournal()
+    model.changes = ChangeLog(step = model.cant_steps)
+    model.place_border()
+
+    # The interior agents are written straight into the grid and its registries,
+    # the occupancy array is filled with array operations and the empties set rebuilt once
+    grid = model.grid
+    cells = grid.cells
+    for i, (x, y) in enumerate(shelves.tolist()):
+        shelf = ObstacleAgent(i, model, "shelf")
+        shelf.pos = (x, y)
+        grid.grid[x][y] = shelf
+        grid.registries["shelf"][i] = shelf
+    cells[shelves["x"], shelves["y"]] = SHELF
+
+    model.box_index = BoxIndex(width, height)
+    box_agents = []
+    for i, (x, y) in enumerate(boxes.tolist()):
+        box = ObstacleAgent(i, model, "box")
+        box_agents.append(box)
+        if x < 0:
+            box.picked_up = True
+            continue
+        box.pos = (x, y)
+        grid.grid[x][y] = box
+        grid.registries["box"][i] = box
+        model.box_index.add(box)
+    on_floor = boxes["x"] >= 0
+    cells[boxes["x"][on_floor], boxes["y"][on_floor]] = BOX
+    model.box_index.claims = dict(claims.tolist())
+
+    model.zone_queues = [0] * len(model.drop_zones)
+    path_start = 0
+    path_cells = [tuple(cell) for cell in paths.tolist()]
+    for unique_id, x, y, has_box, zone, target, path_length in robot_records.tolist():
+        robot = RobotAgent(unique_id, model)
+        robot.pos = (x, y)
+        robot.has_box = bool(has_box)
+        if zone >= 0:
+            robot.zone = zone
+            model.zone_queues[zone] += 1
+        robot.target = box_agents[target] if target >= 0 else None
+        robot.path = path_cells[path_start:path_start + path_length]
+        path_start += path_length
+        grid.grid[x][y] = robot
+        grid.registries["robot"][unique_id] = robot
+        model.schedule.add(robot)
+    cells[robot_records["x"], robot_records["y"]] = ROBOT
+
+    xs, ys = np.nonzero(cells == EMPTY)
+    grid.empties = set(zip(xs.tolist(), ys.tolist()))
+
+    engine = ENGINES[header["engine"]]
+    tiles = (int(fleet_state[1]), int(fleet_state[2])) if engine == "sharded" else None
+    model.setup_engines(engine, PLANNERS[header["planner"]], int(header["window"]), tiles)
+
+    # Setting up the engines may draw random numbers, so the states go last
+    gauss_next = float(header["gauss_next"])
+    model.random.setstate((int(header["random_version"]), tuple(random_state.tolist()),
+                           None if np.isnan(gauss_next) else gauss_next))
+    if model.engine == "vectorized":
+        hi_state, lo_state, hi_inc, lo_inc, has_uint32, uinteger = (int(value) for value in fleet_state)
+        model.fleet.rng.bit_generator.state = {"bit_generator": "PCG64",
+                                               "state": {"state": hi_state << 64 | lo_state, "inc": hi_inc << 64 | lo_inc},
+                                               "has_uint32": has_uint32, "uinteger": uinteger}
+    elif model.engine == "simultaneous":
+        model.schedule.seed = int(fleet_state[0])
+    elif model.engine == "sharded":
+        model.fleet.seed = int(fleet_state[0])
+    return model
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Immutable per-step views of the warehouse model.
+
+The server keeps the last ModelView of every session and answers its reads
+from it, so a read never waits for a step in progress and never sees half a
+step: whoever steps the model builds a new view afterwards and replaces the
+old one in a single assignment. Nothing in a view changes after it is built.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import numpy as np
+from types import MappingProxyType
+
+def read_only(array):
+    array = array.copy()
+    array.flags.writeable = False
+    return array
+
+class ModelView:
+    """
+    Copy of the state of a RobotModel a client can see.
+    Attributes:
+        current_step: Steps requested by the client, as returned in currentStep
+        step: cant_steps of the model
+        running, dropped_boxes, total_moves: Same as in the model
+        ids, x, y, has_box: Read-only robot arrays, in unique_id order
+        boxes: Read-only mapping from the unique_id to the cell of the boxes on the floor
+        picked_boxes: Read-only mapping from the unique_id to the cell of the boxes picked up
+            since the previous view, or None if the change log didn't remember them
+    """
+    def __init__(self, model, current_step, picked_boxes = None):
+        ids, x, y, has_box = model.robot_arrays()
+        self.current_step = current_step
+        self.step = model.cant_steps
+        self.running = model.running
+        self.dropped_boxes = model.boxes_dropped
+        self.total_moves = model.total_moves
+        self.ids, self.x, self.y, self.has_box = read_only(ids), read_only(x), read_only(y), read_only(has_box)
+        self.boxes = MappingProxyType({box.unique_id: box.pos for box in model.grid.registries["box"].values()})
+        self.picked_boxes = MappingProxyType(dict(picked_boxes)) if picked_boxes is not None else None
+
+    def robots_attributes(self, unique_ids = None):
+        '''Attributes of every robot, or of the robots in unique_ids, in the format of the JSON endpoints.'''
+        if unique_ids is None:
+            selected = slice(None)
+        else:
+            selected = np.isin(self.ids, np.fromiter(unique_ids, dtype = np.int64, count = len(unique_ids)))
+        return [{"x": x, "y": 1, "z": z, "has_box": has_box, "unique_id": unique_id}
+                for unique_id, x, z, has_box in zip(self.ids[selected].tolist(), self.x[selected].tolist(),
+                                                    self.y[selected].tolist(), self.has_box[selected].tolist())]
+
+    def boxes_attributes(self, boxes = None, picked_up = False):
+        '''Attributes of the boxes on the floor, or of the given {unique_id: cell} boxes, in the format of the JSON endpoints.'''
+        boxes = self.boxes if boxes is None else boxes
+        return [{"x": x, "y": 1, "z": z, "tag": "box", "picked_up": picked_up, "unique_id": unique_id}
+                for unique_id, (x, z) in sorted(boxes.items())]
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Phase-level profiler of the simulation steps.
+
+The code of a step takes the time with profiler.clock() and closes each
+phase with profiler.mark(name, start), which returns the time to start the
+next phase from:
+
+    start = profiler.clock()
+    possible_steps = grid.get_neighborhood(...)
+    start = profiler.mark("RobotAgent.neighbourhood", start)
+
+While the profiler is disabled, both are a method call that returns 0. Once
+enabled it adds the count and total time of every phase, and for the steps in
+the trace window it also keeps every span, which export_trace writes as a
+Chrome trace (chrome://tracing, ui.perfetto.dev). The model calls
+step_done() at the end of every step to move the window.
+
+Setting PROFILE_TRACE=path (and optionally PROFILE_STEPS=n, PROFILE_SKIP=n)
+enables the profiler when it is imported: the trace of the n steps after the
+first skipped ones is written to path and the per-phase totals are printed.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import json
+import os
+import threading
+from time import perf_counter_ns
+
+class Profiler:
+    """
+    Per-phase totals and trace spans.
+    Attributes:
+        enabled: False makes clock, mark and step_done no-ops
+        totals: Dictionary from phase name to [count, total nanoseconds]
+        steps: Steps done since the profiler was enabled
+        trace_from, trace_steps: The spans of the steps trace_from to trace_from + trace_steps - 1 are kept
+        tracing: True while the current step is in the trace window
+        events: (name, start, end, thread) of the kept spans, in nanoseconds
+        trace_path: If set, the trace is written there, and the totals printed, when the window ends
+    """
+    def __init__(self):
+        self.enabled = False
+        self.totals = {}
+        self.steps = 0
+        self.trace_from = 0
+        self.trace_steps = 0
+        self.tracing = False
+        self.events = []
+        self.trace_path = None
+
+    def enable(self, trace_steps = 0, trace_from = 0, trace_path = None):
+        '''Starts over and collects the totals, plus the spans of trace_steps steps after the first trace_from.'''
+        self.totals = {}
+        self.events = []
+        self.steps = 0
+        self.trace_from = trace_from
+        self.trace_steps = trace_steps
+        self.trace_path = trace_path
+        self.tracing = trace_from == 0 and trace_steps > 0
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.tracing = False
+
+    def clock(self):
+        '''Start of a phase, 0 while disabled.'''
+        if not self.enabled:
+            return 0
+        return perf_counter_ns()
+
+    def mark(self, name, start):
+        '''Ends the phase name that started at start and returns the start of the next one.'''
+        if not self.enabled:
+            return 0
+        now = perf_counter_ns()
+        # A start taken while the profiler was disabled
+        if not start:
+            return now
+        total = self.totals.get(name)
+        if total is None:
+            total = self.totals[name] = [0, 0]
+        total[0] += 1
+        total[1] += now - start
+        if self.tracing:
+            self.events.append((name, start, now, threading.get_ident()))
+        return now
+
+    def step_done(self):
+        '''Moves the trace window at the end of every step.'''
+        if not self.enabled:
+            return
+        self.steps += 1
+        end = self.trace_from + self.trace_steps
+        self.tracing = self.trace_from <= self.steps < end
+        if self.steps == end and self.trace_steps and self.trace_path is not None:
+            self.export_trace(self.trace_path)
+            print(self.report())
+
+    def summary(self):
+        '''(name, count, total seconds, mean seconds) of every phase, the slowest first.'''
+        rows = [(name, count, total / 1e9, total / count / 1e9) for name, (count, total) in self.totals.items()]
+        return sorted(rows, key = lambda row: row[2], reverse = True)
+
+    def report(self):
+        lines = [f"{'phase':<32} {'count':>9} {'total (ms)':>11} {'mean (us)':>10}"]
+        for name, count, total, mean in self.summary():
+            lines.append(f"{name:<32} {count:>9} {total * 1e3:>11.2f} {mean * 1e6:>10.2f}")
+        return "\n".join(lines)
+
+    def trace(self):
+        '''The kept spans as a Chrome trace dictionary; times are in microseconds from the first span.'''
+        origin = min((start for _, start, _, _ in self.events), default = 0)
+        threads = {}
+        events = []
+        for name, start, end, thread in self.events:
+            events.append({"name": name, "cat": name.split(".")[0], "ph": "X", "pid": os.getpid(),
+                           "tid": threads.setdefault(thread, len(threads)),
+                           "ts": (start - origin) / 1e3, "dur": (end - start) / 1e3})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_trace(self, path):
+        with open(path, "w") as file:
+            json.dump(self.trace(), file)
+
+# Shared by every model of the process
+profiler = Profiler()
+
+if os.environ.get("PROFILE_TRACE"):
+    profiler.enable(int(os.environ.get("PROFILE_STEPS", 10)), int(os.environ.get("PROFILE_SKIP", 0)),
+                    os.environ["PROFILE_TRACE"])
@@ -13,7 +13,243 @@ Autors: Jorge Ramírez Uresti, Octavio Navarro, Luis Ignacio Ferro Salinas, Joan
 from mesa import Agent, Model
 from mesa.time import BaseScheduler
 from mesa.space import SingleGrid
-import math
+from collections import deque
+import heapq
+import random
+import time
+import numpy as np
+from EventJournal import EventJournal, MOVE, PICKUP, DROP, BLOCKED
+from ChangeLog import ChangeLog
+from Profiler import profiler
+
+# Distance stored for cells that cannot reach the drop zone
+UNREACHABLE = np.iinfo(np.int32).max
+
+# Cell states stored in the occupancy array of the WarehouseGrid
+EMPTY, BORDER, SHELF, BOX, ROBOT = range(5)
+CELL_STATES = {"border": BORDER, "shelf": SHELF, "box": BOX, "robot": ROBOT}
+
+class WarehouseGrid(SingleGrid):
+    """
+    SingleGrid that keeps a typed occupancy array and per-tag registries in sync with the agents.
+    Attributes:
+        cells: (width, height) uint8 array with the state (EMPTY, BORDER, SHELF, BOX, ROBOT) of each cell
+        registries: Dictionary from tag to a dictionary from unique_id to the agents on the grid with that tag.
+            The model places the agents of each tag in unique_id order, so the registries iterate in that order
+    """
+    def __init__(self, width, height, torus):
+        super().__init__(width, height, torus)
+        self.cells = np.zeros((width, height), dtype = np.uint8)
+        self.registries = {tag: {} for tag in CELL_STATES}
+
+    def place_agent(self, agent, pos):
+        super().place_agent(agent, pos)
+        self.cells[pos] = CELL_STATES[agent.tag]
+        self.registries[agent.tag][agent.unique_id] = agent
+
+    def move_agent(self, agent, pos):
+        old_pos = agent.pos
+        super().move_agent(agent, pos)
+        self.cells[old_pos] = EMPTY
+        self.cells[agent.pos] = CELL_STATES[agent.tag]
+
+    def remove_agent(self, agent):
+        pos = agent.pos
+        super().remove_agent(agent)
+        del self.registries[agent.tag][agent.unique_id]
+        self.cells[pos] = EMPTY
+
+class BoxIndex:
+    """
+    Bucketed spatial index of the boxes still on the floor.
+    Keeps a claim registry so two robots don't chase the same box.
+    Attributes:
+        bucket_size: Side of the square buckets, in cells
+        buckets: Dictionary from bucket coordinates to the set of boxes inside it
+        claims: Dictionary from box unique_id to the unique_id of the robot chasing it
+        generation: Changes every time a box is added, removed or released, so a robot that found
+            no box can skip its next queries until it changes
+    """
+    def __init__(self, width, height, bucket_size = 8):
+        self.bucket_size = bucket_size
+        self.bucket_width = (width + bucket_size - 1) // bucket_size
+        self.bucket_height = (height + bucket_size - 1) // bucket_size
+        self.buckets = {}
+        self.claims = {}
+        self.count = 0
+        self.generation = 0
+
+    def bucket_of(self, pos):
+        return (pos[0] // self.bucket_size, pos[1] // self.bucket_size)
+
+    def add(self, box):
+        self.buckets.setdefault(self.bucket_of(box.pos), set()).add(box)
+        self.count += 1
+        self.generation += 1
+
+    def remove(self, box):
+        '''Removes a box from the index, releasing its claim. Must be called while box.pos is still set.'''
+        bucket = self.buckets[self.bucket_of(box.pos)]
+        bucket.discard(box)
+        if not bucket:
+            del self.buckets[self.bucket_of(box.pos)]
+        self.claims.pop(box.unique_id, None)
+        self.count -= 1
+        # Picking up a box also opens its cell, which can make other boxes reachable
+        self.generation += 1
+
+    def claim(self, box, robot):
+        self.claims[box.unique_id] = robot.unique_id
+
+    def release(self, box, robot):
+        if self.claims.get(box.unique_id) == robot.unique_id:
+            del self.claims[box.unique_id]
+            self.generation += 1
+
+    def is_claimed_by(self, box, robot):
+        return self.claims.get(box.unique_id) == robot.unique_id
+
+    def nearest_unclaimed(self, pos, accept = None):
+        '''
+        Returns the unclaimed box with the smallest manhattan distance to pos, or None.
+        Buckets are scanned in rings around pos until no closer box can exist.
+        Args:
+            pos: Position to search from
+            accept: Optional predicate; boxes for which it returns False are skipped
+        '''
+        if len(self.claims) >= self.count:
+            return None
+        center_x, center_y = self.bucket_of(pos)
+        best, best_distance = None, None
+        # The ring that reaches the farthest corner of the grid
+        max_ring = max(center_x, self.bucket_width - 1 - center_x, center_y, self.bucket_height - 1 - center_y)
+        for ring in range(max_ring + 1):
+            # Every cell in this ring is at least this far away
+            if best is not None and best_distance <= (ring - 1) * self.bucket_size:
+                break
+            for bucket in self.ring_buckets(center_x, center_y, ring):
+                for box in self.buckets.get(bucket, ()):
+                    if box.unique_id in self.claims:
+                        continue
+                    distance = abs(box.pos[0] - pos[0]) + abs(box.pos[1] - pos[1])
+                    if (best is None or distance < best_distance or
+                            (distance == best_distance and box.unique_id < best.unique_id)):
+                        if accept is None or accept(box):
+                            best, best_distance = box, distance
+        return best
+
+    @staticmethod
+    def ring_buckets(center_x, center_y, ring):
+        '''Buckets on the perimeter of the square of side 2 * ring + 1 around the center one.'''
+        if ring == 0:
+            return [(center_x, center_y)]
+        buckets = []
+        for bucket_x in range(center_x - ring, center_x + ring + 1):
+            buckets += [(bucket_x, center_y - ring), (bucket_x, center_y + ring)]
+        for bucket_y in range(center_y - ring + 1, center_y + ring):
+            buckets += [(center_x - ring, bucket_y), (center_x + ring, bucket_y)]
+        return buckets
+
+class DistanceField:
+    """
+    Shortest path distance from every cell to the closest source cell,
+    walking only through passable cells (empty or robot).
+    It is built once and then updated incrementally as cells open; boxes are
+    only ever taken off the floor, so no cell closes while the model runs.
+    Attributes:
+        distances: (width, height) int32 array; UNREACHABLE for cells without a path
+        sources: Set of source positions, their distance is always 0
+    """
+    def __init__(self, grid, sources):
+        self.grid = grid
+        self.sources = set(sources)
+        self.distances = np.full((grid.width, grid.height), UNREACHABLE, dtype = np.int32)
+        self.rebuild()
+
+    def neighbors(self, pos):
+        return self.grid.get_neighborhood(pos, moore = False, include_center = False)
+
+    def is_passable(self, pos):
+        state = self.grid.cells[pos]
+        return state == EMPTY or state == ROBOT
+
+    def rebuild(self):
+        '''
+        Breadth first search from all the sources. Updates the distances array in place.
+        Each level of the search is expanded at once with array operations.
+        '''
+        distances = self.distances
+        cells = self.grid.cells
+        width, height = distances.shape
+        passable = (cells == EMPTY) | (cells == ROBOT)
+        distances.fill(UNREACHABLE)
+        if not self.sources:
+            return
+        frontier_x, frontier_y = (np.array(axis, dtype = np.int64) for axis in zip(*self.sources))
+        distances[frontier_x, frontier_y] = 0
+        # Scratch array used to drop the cells reached twice in the same level
+        stamp = np.empty((width, height), dtype = np.int64)
+        level = 0
+        while frontier_x.size:
+            level += 1
+            next_x = np.concatenate((frontier_x - 1, frontier_x + 1, frontier_x, frontier_x))
+            next_y = np.concatenate((frontier_y, frontier_y, frontier_y - 1, frontier_y + 1))
+            inside = (next_x >= 0) & (next_x < width) & (next_y >= 0) & (next_y < height)
+            next_x, next_y = next_x[inside], next_y[inside]
+            new = passable[next_x, next_y] & (distances[next_x, next_y] == UNREACHABLE)
+            next_x, next_y = next_x[new], next_y[new]
+            order = np.arange(next_x.size)
+            stamp[next_x, next_y] = order
+            first = stamp[next_x, next_y] == order
+            frontier_x, frontier_y = next_x[first], next_y[first]
+            distances[frontier_x, frontier_y] = level
+
+    def relax(self, queue):
+        '''Propagates decreased distances outwards from the cells in the queue.'''
+        distances = self.distances
+        while queue:
+            current = queue.popleft()
+            next_distance = distances[current] + 1
+            for neighbor in self.neighbors(current):
+                if distances[neighbor] > next_distance and self.is_passable(neighbor):
+                    distances[neighbor] = next_distance
+                    queue.append(neighbor)
+
+    def cell_opened(self, pos):
+        '''
+        Updates the field after an obstacle leaves the cell.
+        Distances can only decrease, so they are relaxed outwards from the cell.
+        '''
+        distances = self.distances
+        if pos in self.sources:
+            return
+        best = min(distances[n] for n in self.neighbors(pos))
+        if best == UNREACHABLE or best + 1 >= distances[pos]:
+            return
+        distances[pos] = best + 1
+        self.relax(deque([pos]))
+
+class FreeCellPool:
+    """
+    Pool of the free interior cells of the grid (every cell but the border).
+    Taking a random cell swaps it with the last free one and shrinks the pool,
+    so placement costs O(1) no matter how full the floor is.
+    """
+    def __init__(self, width, height, random):
+        self.inner_height = height - 2
+        self.cells = list(range((width - 2) * self.inner_height))
+        self.size = len(self.cells)
+        self.random = random
+
+    def take(self):
+        '''Removes a random cell from the pool and returns its position.'''
+        if self.size == 0:
+            raise ValueError(f"All the {len(self.cells)} interior cells of the grid are taken")
+        index = self.random.randrange(self.size)
+        self.size -= 1
+        cell = self.cells[index]
+        self.cells[index] = self.cells[self.size]
+        return (1 + cell // self.inner_height, 1 + cell % self.inner_height)
 
 class RobotAgent(Agent):
     """
@@ -32,71 +268,134 @@ class RobotAgent(Agent):
         super().__init__(unique_id, model)
         self.has_box = False
         self.tag = "robot"
+        # Box this robot is heading to and the cells left to reach it
+        self.target = None
+        self.path = []
+        # Index of the drop zone the robot was assigned when it picked up its box
+        self.zone = None
+        # BoxIndex.generation of the last search that found no box
+        self.missed_generation = None
 
     def step(self):
         """ 
         Determines if the agent can move in the direction that was chosen
         """
+        # Phases of the step, for the profiler (a no-op unless it is enabled)
+        phase = profiler.clock()
         possible_steps = self.model.grid.get_neighborhood(
             self.pos,
             moore = False, # Boolean for whether to use Moore neighborhood (including diagonals) or Von Neumann (only up/down/left/right).
             include_center = False)
+        phase = profiler.mark("RobotAgent.neighbourhood", phase)
 
-        box = None
-        presentInCell = self.model.grid.get_cell_list_contents(possible_steps)
-        for agent in presentInCell:
-            if(agent.tag == "box"):
-                box = agent
+        cells = self.model.grid.cells
+        states = [cells[pos] for pos in possible_steps]
+        phase = profiler.mark("RobotAgent.contents", phase)
 
-        if(self.has_box and self.model.drop_zone in possible_steps):
+        if(self.has_box and self.model.drop_zones[self.zone] in possible_steps):
             # Leave box
             self.model.boxes_dropped += 1
             self.has_box = False
+            self.model.release_drop_zone(self.zone)
+            self.model.journal.record(self.model.cant_steps, DROP, self.unique_id, *self.model.drop_zones[self.zone])
+            self.model.changes.record(self.model.cant_steps + 1, robots = (self.unique_id,))
+            self.zone = None
+            profiler.mark("RobotAgent.drop", phase)
             return
 
-        elif(box and not self.has_box):
-            # Pick up box
-            box.picked_up = True
-            self.model.grid.remove_agent(box)
+        elif(BOX in states and not self.has_box):
+            # Pick up box, the claimed one if it is next to the robot
+            if self.target is not None and self.target.pos in possible_steps:
+                box = self.target
+            else:
+                box_pos = possible_steps[states.index(BOX)]
+                box = self.model.grid[box_pos[0]][box_pos[1]]
+            self.release_target()
+            box_pos = self.model.remove_box(box)
             self.has_box = True
+            self.zone = self.model.assign_drop_zone(self.pos)
+            self.model.journal.record(self.model.cant_steps, PICKUP, self.unique_id, *box_pos)
+            self.model.changes.record(self.model.cant_steps + 1, robots = (self.unique_id,), boxes = {box.unique_id: box_pos})
+            profiler.mark("RobotAgent.pickup", phase)
             return
 
-        freeSpaces = list(map(self.model.grid.is_cell_empty, possible_steps))
         cell_to_move = None
-        empty_positions = []
-        for i in range(0, len(possible_steps)):
-            list_with_agent_in_cell = self.model.grid.get_cell_list_contents([possible_steps[i]])
-            if freeSpaces[i] == True:  # If theres an empty cell or a box cell thats picked up.
-                empty_positions.append(possible_steps[i])
-            elif list_with_agent_in_cell[0].tag == "box":
-                if list_with_agent_in_cell[0].picked_up == True:
-                    empty_positions.append(possible_steps[i])
-        
-        if(self.has_box):
-            # Return to drop zone
-            distance = math.inf
-            index_min_distance = None
-            for index, cell in enumerate(empty_positions):
-                distance_from_cell = math.sqrt((cell[0] - self.model.drop_zone[0])**2+(cell[1] - self.model.drop_zone[1])**2)
-                if(distance_from_cell < distance):
-                    distance = distance_from_cell
-                    index_min_distance = index
-
-            if(isinstance(index_min_distance, int)):
-                cell_to_move = empty_positions[index_min_distance]
+        # Boxes that were picked up are removed from the grid, so their cells are EMPTY
+        empty_positions = [pos for pos, state in zip(possible_steps, states) if state == EMPTY]
 
-        else:
-            cell_to_move = self.model.random.choice(empty_positions)
+        if self.model.planner is not None:
+            # Follow the cooperative plan, which may also mean waiting in place
+            cell_to_move = self.model.planner.next_cell(self, empty_positions)
+
+        elif(self.has_box):
+            # Return to drop zone following the shortest path distance field
+            if empty_positions:
+                distances = self.model.drop_fields[self.zone].distances
+                cell_to_move = min(empty_positions, key = lambda cell: distances[cell[0], cell[1]])
+
+        elif empty_positions:
+            cell_to_move = self.next_cell_to_target(empty_positions)
+        phase = profiler.mark("RobotAgent.choose_cell", phase)
 
         # If the cell is empty, moves the agent to that cell; otherwise, it stays at the same position
         if cell_to_move:
-            print(f"El agente {self.unique_id} se mueve de {self.pos}", end = " ")
             self.model.total_moves += 1
             # The agents were trying to move into positions of boxes that we couldnt see they were picked up single grid crashed.
             self.model.grid.move_agent(self, cell_to_move)
-            print(f"a {cell_to_move}")
+            self.model.journal.record(self.model.cant_steps, MOVE, self.unique_id, *cell_to_move)
+            self.model.changes.record(self.model.cant_steps + 1, robots = (self.unique_id,))
         else:
-            print(f"El agente {self.unique_id} no se puede mover de {self.pos}. No hay celdas vacias")
+            self.model.journal.record(self.model.cant_steps, BLOCKED, self.unique_id, *self.pos)
+        profiler.mark("RobotAgent.move", phase)
+
+
+    def release_target(self):
+        '''Releases the claim on the current target box.'''
+        if self.target is not None:
+            self.model.box_index.release(self.target, self)
+            self.target = None
+            self.path = []
+
+    def update_target(self):
+        '''Claims the nearest unclaimed reachable box if the robot is not chasing one.'''
+        box_index = self.model.box_index
+        if self.target is not None and not box_index.is_claimed_by(self.target, self):
+            # The box was picked up by another robot
+            self.target = None
+            self.path = []
+
+        # Nothing changed since the last search found no box, so it would find none again. A robot
+        # walled off from the drop zones can't reach any of the reachable boxes either
+        if (self.target is None and self.missed_generation != box_index.generation and
+                self.model.drop_distances[self.pos] != UNREACHABLE):
+            box = box_index.nearest_unclaimed(self.pos, self.model.is_box_reachable)
+            if box is not None:
+                box_index.claim(box, self)
+                self.target = box
+            else:
+                self.missed_generation = box_index.generation
+
+    def next_cell_to_target(self, empty_positions):
+        '''
+        Chooses the next cell of the path to the nearest unclaimed box.
+        Falls back to a random free neighbour when there is no box to chase
+        or when the path is blocked by another robot.
+        '''
+        self.update_target()
+
+        if self.target is not None and not self.path:
+            path = self.model.find_path(self.pos, self.target.pos)
+            if path is None:
+                self.release_target()
+            else:
+                self.path = path
+
+        if self.path and self.path[-1] in empty_positions:
+            return self.path.pop()
+
+        # Blocked or nothing to chase: step aside and plan again next time
+        self.path = []
+        return self.model.random.choice(empty_positions)
 
 
 class ObstacleAgent(Agent):
@@ -117,62 +416,280 @@ class RobotModel(Model):
     Args:
         N: Number of agents in the simulation
         height, width: The size of the grid to model
+        engine: "agents" to step each RobotAgent in turn, "vectorized" to step the whole fleet with a FleetEngine,
+            "simultaneous" to step every robot against the same snapshot with a SimultaneousScheduler,
+            "sharded" to step each tile of the grid in its own process with a ShardedEngine
+        seed: Seed of the random number generator of the model; None seeds it from the system
+        journal: EventJournal that records the moves, pickups and drops; by default an in-memory one
+        changes: ChangeLog with the robots and boxes changed in the last steps
+        planner: None for greedy robots, "cooperative" for windowed cooperative A* with a shared reservation table
+        window: Number of steps each robot plans and reserves ahead with the cooperative planner
+        N_drop_zones: Number of drop zones; loaded robots are assigned the one with the lowest distance + queue_weight * queue
+        queue_weight: Cost, in cells, of each robot already heading to a drop zone
+        tiles: (columns, rows) of the tiles the sharded engine splits the grid into
+    Attributes:
+        step_observer: Optional function called with the duration, in seconds, of every step run;
+            set it on each model, e.g. to fill a metrics histogram
     """
-    def __init__(self, N, max_shelves, N_boxes, width, height, max_moves):
+    # Default of the models that don't set one; a function set here would be bound as a method
+    step_observer = None
+
+    def __init__(self, N, max_shelves, N_boxes, width, height, max_moves, engine = "agents", seed = None, journal = None,
+                 planner = None, window = 8, N_drop_zones = 1, queue_weight = 2, tiles = (2, 2)):
+        # Model.__new__ puts one generator on the class, shared by every model, so this one gets its own
+        self.random = random.Random(seed)
         self.num_agents = max([5,N])
         self.shelves = self.random.randrange(max_shelves)
         self.num_boxes = N_boxes
-        self.grid = SingleGrid(width,height,torus = False) 
+        self.grid = WarehouseGrid(width,height,torus = False) 
         self.schedule = BaseScheduler(self)
         self.running = True
-        self.drop_zone = (self.random.randrange(1, self.grid.width - 1), 
-                          self.random.randrange(1, self.grid.height -1))
+        # Distinct interior cells, drawn without replacement
+        interior = (width - 2) * (height - 2)
+        if max(1, N_drop_zones) > interior:
+            raise ValueError(f"Can't fit {N_drop_zones} drop zones in the {interior} interior cells of the grid")
+        placed = self.shelves + max(0, N_boxes) + self.num_agents
+        if placed > interior:
+            raise ValueError(f"Can't fit {self.shelves} shelves, {N_boxes} boxes and {self.num_agents} robots "
+                             f"({placed} cells) in the {interior} interior cells of the grid")
+        zone_cells = FreeCellPool(width, height, self.random)
+        self.drop_zones = [zone_cells.take() for _ in range(max(1, N_drop_zones))]
+        self.drop_zone = self.drop_zones[0]
+        # Number of loaded robots heading to each drop zone
+        self.zone_queues = [0] * len(self.drop_zones)
+        self.queue_weight = queue_weight
         self.boxes_dropped = 0
         self.cant_steps = 0
         self.total_moves = 0
         self.max_moves = max_moves
+        self.journal = journal if journal is not None else EventJournal()
+        # Robots and boxes changed in each step, for the clients that only want what changed
+        self.changes = ChangeLog()
 
-        # Creates the border of the grid
-        border = [(x,y) for y in range(height) for x in range(width) if y in [0, height-1] or x in [0, width - 1]]
+        self.place_border()
 
-        # Add the barriers at the border of existing grid, not outside of it.
-        for ind, pos in enumerate(border):
-            obs = ObstacleAgent(ind, self, "border")
-            self.grid.place_agent(obs, pos)
+        # Every shelf, box and robot takes its cell from the pool of free interior cells
+        free_cells = FreeCellPool(width, height, self.random)
 
         # Add shelves to a random empty grid cell
         for i in range(self.shelves):
             obj = ObstacleAgent(i, self, "shelf")
-            pos_gen = lambda w, h: (self.random.randrange(1, w - 1), self.random.randrange(1, h - 1))
-            pos = pos_gen(self.grid.width, self.grid.height)
-            while (not self.grid.is_cell_empty(pos)):
-                pos = pos_gen(self.grid.width, self.grid.height)
-            self.grid.place_agent(obj, pos)
+            self.grid.place_agent(obj, free_cells.take())
+
+        # Spatial index of the boxes that robots still have to pick up
+        self.box_index = BoxIndex(width, height)
 
         # Add boxes to a random empty grid cell
         for i in range(self.num_boxes):
             obj = ObstacleAgent(i, self, "box")
-            pos_gen = lambda w, h: (self.random.randrange(1, w - 1), self.random.randrange(1, h - 1))
-            pos = pos_gen(self.grid.width, self.grid.height)
-            while (not self.grid.is_cell_empty(pos)):
-                pos = pos_gen(self.grid.width, self.grid.height)
-            self.grid.place_agent(obj, pos)
+            self.grid.place_agent(obj, free_cells.take())
+            self.box_index.add(obj)
 
         # Add the agent to a random empty grid cell
         for i in range(self.num_agents):
             a = RobotAgent(i+1000, self) 
             self.schedule.add(a)
-            pos_gen = lambda w, h: (self.random.randrange(1, w - 1), self.random.randrange(1, h - 1))
-            pos = pos_gen(self.grid.width, self.grid.height)
-            while (not self.grid.is_cell_empty(pos)):
-                pos = pos_gen(self.grid.width, self.grid.height)
-            self.grid.place_agent(a, pos)
+            self.grid.place_agent(a, free_cells.take())
+
+        self.setup_engines(engine, planner, window, tiles)
+
+    def place_border(self):
+        '''Creates the border of the grid straight from the perimeter coordinates.'''
+        width, height = self.grid.width, self.grid.height
+        border = [(x, 0) for x in range(width)]
+        for y in range(1, height - 1):
+            border += [(0, y), (width - 1, y)]
+        border += [(x, height - 1) for x in range(width)]
+
+        # Add the barriers at the border of existing grid, not outside of it.
+        for ind, pos in enumerate(border):
+            obs = ObstacleAgent(ind, self, "border")
+            self.grid.place_agent(obs, pos)
+
+    def setup_engines(self, engine, planner, window, tiles = (2, 2)):
+        '''Builds the distance fields, the planner and the step engine for the agents already on the grid.'''
+        # Shortest path distance from every cell to each drop zone, and to the closest one
+        self.drop_fields = [DistanceField(self.grid, [zone]) for zone in self.drop_zones]
+        self.drop_field = DistanceField(self.grid, self.drop_zones) if len(self.drop_zones) > 1 else self.drop_fields[0]
+        self.drop_distances = self.drop_field.distances
+        self.distance_fields = list(self.drop_fields)
+        if len(self.drop_zones) > 1:
+            self.distance_fields.append(self.drop_field)
+        # Distance to the boxes on the floor, for the engines whose empty robots follow it
+        self.box_field = None
+
+        self.window = window
+        self.planner = None
+        if planner == "cooperative":
+            from CooperativePlanner import CooperativePlanner
+            self.planner = CooperativePlanner(self, window)
+        elif planner is not None:
+            raise ValueError(f"Unknown planner {planner}")
+
+        self.engine = engine
+        self.fleet = None
+        if engine == "vectorized":
+            from FleetEngine import FleetEngine
+            self.fleet = FleetEngine(self)
+        elif engine == "simultaneous":
+            from SimultaneousScheduler import SimultaneousScheduler
+            schedule = self.schedule
+            self.schedule = SimultaneousScheduler(self, schedule.agents, self.random.getrandbits(64))
+            self.schedule.steps, self.schedule.time = schedule.steps, schedule.time
+        elif engine == "sharded":
+            from ShardedEngine import ShardedEngine
+            self.fleet = ShardedEngine(self, tiles, self.random.getrandbits(64))
+        elif engine != "agents":
+            raise ValueError(f"Unknown engine {engine}")
+
+    def close(self):
+        '''Stops the worker processes of the sharded engine; the other engines have nothing to stop.'''
+        if self.engine == "sharded":
+            self.fleet.close()
+
+    def save(self, path):
+        '''Writes a compact binary snapshot of the model to path. See ModelSnapshot.'''
+        from ModelSnapshot import save_model
+        save_model(self, path)
+
+    @classmethod
+    def load(cls, path, journal = None):
+        '''Restores a model written with save; the loaded model records into journal.'''
+        from ModelSnapshot import load_model
+        return load_model(cls, path, journal)
+
+    def robot_arrays(self):
+        '''Returns the unique_id, x, y and has_box arrays of the robots, in unique_id order.'''
+        if self.fleet is not None:
+            return self.fleet.ids, self.fleet.x, self.fleet.y, self.fleet.has_box
+        robots = list(self.grid.registries["robot"].values())
+        ids = np.fromiter((robot.unique_id for robot in robots), dtype = np.int64, count = len(robots))
+        x = np.fromiter((robot.pos[0] for robot in robots), dtype = np.int64, count = len(robots))
+        y = np.fromiter((robot.pos[1] for robot in robots), dtype = np.int64, count = len(robots))
+        has_box = np.fromiter((robot.has_box for robot in robots), dtype = bool, count = len(robots))
+        return ids, x, y, has_box
+
+    def assign_drop_zone(self, pos):
+        '''Picks the drop zone for a robot that just picked up a box at pos and adds it to its queue.'''
+        costs = [int(field.distances[pos]) + self.queue_weight * queue
+                 for field, queue in zip(self.drop_fields, self.zone_queues)]
+        zone = costs.index(min(costs))
+        self.zone_queues[zone] += 1
+        return zone
+
+    def release_drop_zone(self, zone):
+        self.zone_queues[zone] -= 1
+
+    def is_box_reachable(self, box):
+        '''Returns True if a robot can stand next to the box and carry it to the drop zone.'''
+        distances = self.drop_distances
+        return any(distances[n] != UNREACHABLE
+                   for n in self.grid.get_neighborhood(box.pos, moore = False, include_center = False))
+
+    def find_path(self, start, goal):
+        '''
+        A* search over the passable cells, guided by the manhattan distance to goal.
+        Returns the cells to walk, from the last one (next to goal) to the first
+        one (next to start), so the next cell can be taken with pop(); None if there is no path.
+        '''
+        cells = self.grid.cells
+        goal_x, goal_y = goal
+        parents = {start: None}
+        costs = {start: 0}
+        # (estimate, -cost, insertion order, cell): among equal estimates the cells closest to goal go
+        # first, so on an open floor the search runs straight to it instead of filling the rectangle
+        heap = [(abs(start[0] - goal_x) + abs(start[1] - goal_y) - 1, 0, 0, start)]
+        pushed = 0
+        while heap:
+            _, _, _, current = heapq.heappop(heap)
+            x, y = current
+            if abs(x - goal_x) + abs(y - goal_y) == 1:
+                path = []
+                while current != start:
+                    path.append(current)
+                    current = parents[current]
+                return path
+            cost = costs[current] + 1
+            # Same order as get_neighborhood; the border is never passable, so they are inside the grid
+            for neighbor in ((x - 1, y), (x, y - 1), (x, y + 1), (x + 1, y)):
+                if cost < costs.get(neighbor, UNREACHABLE):
+                    state = cells[neighbor]
+                    if state == EMPTY or state == ROBOT:
+                        costs[neighbor] = cost
+                        parents[neighbor] = current
+                        pushed += 1
+                        estimate = cost + abs(neighbor[0] - goal_x) + abs(neighbor[1] - goal_y) - 1
+                        heapq.heappush(heap, (estimate, -cost, pushed, neighbor))
+        return None
+
+    def box_distance_field(self):
+        '''Builds the box field from the boxes on the floor; remove_box keeps its sources up to date.'''
+        box_sources = list(zip(*np.nonzero(self.grid.cells == BOX)))
+        self.box_field = DistanceField(self.grid, [(int(x), int(y)) for x, y in box_sources])
+        self.distance_fields.append(self.box_field)
+        return self.box_field
+
+    def remove_box(self, box):
+        '''
+        Takes a picked up box off the floor, out of the box index and out of the distance fields.
+        The box field only loses the source: the engine rebuilds it once for all the pickups of
+        the step, as removing the last boxes one by one would invalidate most of the floor each time.
+        '''
+        pos = box.pos
+        box.picked_up = True
+        self.box_index.remove(box)
+        self.grid.remove_agent(box)
+        for field in self.distance_fields:
+            if field is self.box_field:
+                field.sources.discard(pos)
+            else:
+                field.cell_opened(pos)
+        return pos
+
+    def finished(self):
+        '''True once every box is dropped or the moves run out.'''
+        return self.boxes_dropped >= self.num_boxes or self.cant_steps >= self.max_moves
 
     def step(self):
-        '''Advance the model by one step.'''
-        if(self.boxes_dropped < self.num_boxes and self.max_moves > self.cant_steps):
-            self.schedule.step()
+        '''
+        Advance the model by one step and returns whether a step was run.
+        The model stops as soon as it is finished, on the step that finished it.
+        '''
+        ran = not self.finished()
+        if ran:
+            start = time.perf_counter()
+            phase = profiler.clock()
+            if self.fleet is not None:
+                self.fleet.step()
+            else:
+                self.schedule.step()
             self.cant_steps += 1
-        else:
-            print(f"FINISHED\nTotal steps: {self.cant_steps}")
-            print(f"FINISHED\nTotal moves: {self.total_moves}")
+            profiler.mark("RobotModel.step", phase)
+            profiler.step_done()
+            if self.step_observer is not None:
+                self.step_observer(time.perf_counter() - start)
+        if self.running and self.finished():
+            self.running = False
+            self.journal.flush()
+            if self.journal.verbose:
+                print(f"FINISHED\nTotal steps: {self.cant_steps}")
+                print(f"FINISHED\nTotal moves: {self.total_moves}")
+        return ran
+
+    def advance(self, steps = 1, until_done = False, budget = None):
+        '''
+        Runs several steps in a row and returns how many were run.
+        Args:
+            steps: Number of steps to run
+            until_done: If True, runs until the model stops, ignoring steps
+            budget: Optional wall-clock limit, in seconds; at least one step is always run
+        '''
+        deadline = time.perf_counter() + budget if budget is not None else None
+        count = 0
+        while self.running and (until_done or count < steps):
+            if count and deadline is not None and time.perf_counter() >= deadline:
+                break
+            if not self.step():
+                break
+            count += 1
+        return count
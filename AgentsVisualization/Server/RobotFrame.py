@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Packed binary frames with the state of the warehouse robots.
+
+The server sends a frame instead of JSON when the client asks for
+FRAME_MIMETYPE in its Accept header. Every value is little-endian and there
+is no padding, so a client can read the frame with a plain binary reader
+(BinaryReader in C#):
+
+    Header, 21 bytes
+        char[4]  magic            "WHF1"
+        uint32   step             Current step of the server
+        uint32   dropped_boxes    Boxes left in the drop zones
+        uint8    flags            bit 0: the model is running
+                                  bit 1: full, the boxes are every box on the
+                                         floor instead of the boxes picked up
+        uint32   robot_count
+        uint32   box_count
+    robot_count robot records, 9 bytes each, sorted by id
+        int32    id
+        int16    x
+        int16    z
+        uint8    flags            bit 0: has_box
+    box_count box records, 8 bytes each
+        int32    id
+        int16    x
+        int16    z
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import numpy as np
+
+FRAME_MIMETYPE = "application/x-warehouse-frame"
+MAGIC = b"WHF1"
+RUNNING, FULL = 1, 2
+HAS_BOX = 1
+
+HEADER = np.dtype([("magic", "S4"), ("step", "<u4"), ("dropped_boxes", "<u4"), ("flags", "u1"),
+                   ("robot_count", "<u4"), ("box_count", "<u4")])
+ROBOT = np.dtype([("id", "<i4"), ("x", "<i2"), ("z", "<i2"), ("flags", "u1")])
+BOX = np.dtype([("id", "<i4"), ("x", "<i2"), ("z", "<i2")])
+
+def encode_frame(step, dropped_boxes, running, ids, x, z, has_box, box_ids = (), box_x = (), box_z = (), full = False):
+    '''Packs the robot arrays (and optionally boxes) into a frame.'''
+    header = np.zeros(1, dtype = HEADER)
+    header[0] = (MAGIC, step, dropped_boxes, (RUNNING if running else 0) | (FULL if full else 0), len(ids), len(box_ids))
+    robots = np.empty(len(ids), dtype = ROBOT)
+    robots["id"] = ids
+    robots["x"] = x
+    robots["z"] = z
+    robots["flags"] = np.asarray(has_box, dtype = np.uint8) * HAS_BOX
+    boxes = np.empty(len(box_ids), dtype = BOX)
+    boxes["id"] = box_ids
+    boxes["x"] = box_x
+    boxes["z"] = box_z
+    return header.tobytes() + robots.tobytes() + boxes.tobytes()
+
+def decode_frame(data):
+    '''Reads a frame back into (header record, robot records, box records).'''
+    header = np.frombuffer(data, dtype = HEADER, count = 1)[0]
+    if header["magic"] != MAGIC:
+        raise ValueError("Not a robot frame")
+    robots = np.frombuffer(data, dtype = ROBOT, count = int(header["robot_count"]), offset = HEADER.itemsize)
+    boxes = np.frombuffer(data, dtype = BOX, count = int(header["box_count"]),
+                          offset = HEADER.itemsize + robots.nbytes)
+    return header, robots, boxes
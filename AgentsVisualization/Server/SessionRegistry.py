@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Sessions of the warehouse server.
+
+Each client gets its own session with its own RobotModel, so one server process
+can run many simulations at once. Sessions live in a bounded registry: the
+least recently used ones are evicted when there are too many of them or when
+the estimated memory of their models goes over the cap, and sessions nobody
+used for idle_timeout seconds are evicted as well, on the next request that
+creates or looks up a session. Requests that don't name a session use the
+default one, the last created without an explicit id, so the clients written
+for a single simulation keep working.
+
+Requests run in several threads. Only one of them steps a session's model at
+a time, holding the session lock; the others read the session's last
+ModelView, which is never modified, so reads don't wait for the step.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# Rough size of an agent with its attribute dictionary and grid entry
+AGENT_BYTES = 600
+# Occupancy byte, grid list slot and worst case entry in the empties set of each cell
+CELL_BYTES = 1 + 8 + 64
+# Resident memory of a spawned tile worker of the sharded engine: an interpreter with numpy and mesa imported
+WORKER_BYTES = 36 * 1024**2
+
+# Dictionary entry of each box in a ModelView; its robot arrays are measured
+VIEW_BOX_BYTES = 40
+
+def view_bytes(view):
+    '''Estimated memory of a ModelView, what every frame buffered by a LookAhead costs.'''
+    return sum(array.nbytes for array in (view.ids, view.x, view.y, view.has_box)) + len(view.boxes) * VIEW_BOX_BYTES
+
+def model_bytes(model):
+    '''Estimated memory used by a RobotModel, including the worker processes and shared memory of a sharded one.'''
+    cells = model.grid.width * model.grid.height
+    agents = sum(len(registry) for registry in model.grid.registries.values())
+    fields = sum(field.distances.nbytes for field in model.distance_fields)
+    size = cells * CELL_BYTES + fields + agents * AGENT_BYTES
+    if model.engine == "sharded":
+        size += len(model.fleet.processes) * WORKER_BYTES + sum(block.size for block in model.fleet.blocks)
+    return size
+
+class Session:
+    """
+    State of one client of the server.
+    Attributes:
+        session_id: Key of the session in the registry
+        model: RobotModel of the session
+        current_step: Steps requested by the client, as returned in currentStep
+        view: ModelView of the model after the last step, what the reads of the session are served from
+        lock: Held by the request or thread stepping the model
+        layout_bytes, layout_etag: Pre-encoded borders and shelves of the model and their ETag
+        stream: StepStream stepping the model for its subscribers, if any
+        look_ahead: LookAhead stepping the model ahead of the client, if any
+        last_used: time.monotonic() of the last request of the session
+        size: Estimated memory of the model and its look-ahead frames, in bytes
+    """
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.model = None
+        self.current_step = 0
+        self.view = None
+        self.lock = threading.Lock()
+        self.layout_bytes = b""
+        self.layout_etag = ""
+        self.stream = None
+        self.look_ahead = None
+        self.last_used = time.monotonic()
+        self.size = 0
+
+    def stop_stream(self):
+        if self.stream is not None:
+            with self.stream.lock:
+                self.stream.stop()
+            self.stream = None
+
+    def stop_look_ahead(self):
+        if self.look_ahead is not None:
+            self.look_ahead.stop()
+            self.look_ahead = None
+
+    def close_model(self):
+        '''Stops the worker processes of a sharded model; requests still holding the session can't step it anymore.'''
+        if self.model is not None:
+            self.model.close()
+
+    def close(self):
+        '''Stops everything running for the session; called without the registry lock, as it waits for those threads.'''
+        self.stop_stream()
+        self.stop_look_ahead()
+        self.close_model()
+
+class SessionRegistry:
+    """
+    Bounded, least recently used first, dictionary of sessions.
+    Attributes:
+        max_sessions: Most sessions kept at once
+        idle_timeout: Seconds without requests after which a session is evicted
+        memory_cap: Most estimated model memory, in bytes, kept at once
+        sessions: OrderedDict from session id to Session, least recently used first
+        default_id: Session used by the requests that don't name one
+        lock: Held while the registry is read or changed; never while a removed session is closed
+    """
+    def __init__(self, max_sessions = 32, idle_timeout = 1800, memory_cap = 2 * 1024**3):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.memory_cap = memory_cap
+        self.sessions = OrderedDict()
+        self.default_id = None
+        self.lock = threading.RLock()
+
+    def create(self, session_id = None):
+        '''Adds an empty session, replacing the one with the same id if there is one.'''
+        with self.lock:
+            removed = self.pop_idle()
+            session_id = session_id or secrets.token_urlsafe(12)
+            if session_id in self.sessions:
+                removed.append(self.pop(session_id))
+            session = Session(session_id)
+            self.sessions[session_id] = session
+            while len(self.sessions) > self.max_sessions:
+                removed.append(self.pop(next(iter(self.sessions))))
+        for old in removed:
+            old.close()
+        return session
+
+    def get(self, session_id = None):
+        '''Returns the session (the default one if session_id is None) and marks it as used, or None.'''
+        with self.lock:
+            removed = self.pop_idle()
+            session_id = session_id or self.default_id
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_used = time.monotonic()
+                self.sessions.move_to_end(session_id)
+        for old in removed:
+            old.close()
+        return session
+
+    def resize(self, session, size):
+        '''Records the memory of the session's model and evicts other sessions while over the cap.'''
+        removed = []
+        with self.lock:
+            session.size = size
+            total = sum(other.size for other in self.sessions.values())
+            for session_id in list(self.sessions):
+                if total <= self.memory_cap:
+                    break
+                if session_id != session.session_id:
+                    total -= self.sessions[session_id].size
+                    removed.append(self.pop(session_id))
+        for old in removed:
+            old.close()
+
+    def pop_idle(self):
+        '''Takes the idle sessions out of the registry, with the lock held, and returns them to be closed.'''
+        deadline = time.monotonic() - self.idle_timeout
+        # Sessions with a running stream are in use even if their subscribers send no requests
+        return [self.pop(session_id) for session_id in [key for key, session in self.sessions.items()
+                if session.last_used < deadline and (session.stream is None or session.stream.stopped)]]
+
+    def pop(self, session_id):
+        '''Takes the session out of the registry, with the lock held, and returns it to be closed.'''
+        session = self.sessions.pop(session_id)
+        if self.default_id == session_id:
+            self.default_id = None
+        return session
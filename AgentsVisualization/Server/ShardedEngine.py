@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+Spatially sharded step engine for the warehouse robots.
+
+The grid is split into columns x rows rectangular tiles and each tile is
+stepped by its own worker process, with the rules of the SimultaneousScheduler.
+The occupancy array, the robot of every cell, the box of every cell, the
+robot arrays and the distance fields live in shared memory:
+
+    1. Every worker copies its tile plus a halo of HALO cells around it. The
+       halo rows are the ones the neighbour tiles wrote in the previous step,
+       so this is the whole halo exchange. Then all of them wait at a barrier.
+    2. Every worker calls propose() for its robots and for the robots of the
+       other tiles within two cells of its own, and settles the claims that
+       cross a tile border: a robot may only leave its tile as its first
+       choice and into a cell that was empty, and each such cell, or box
+       reached from another tile, goes to the claimant with the highest
+       priority. Both tiles see the same claimants, so they agree on the
+       winner without talking to each other. The rest is settled inside each
+       tile with resolve().
+    3. Every worker writes its own tile and its own robots. A robot that moved
+       into another tile is migrated: the tile it arrived at writes it into
+       its cell and owns it from then on.
+
+The coordinator (the ShardedEngine in the model's process) merges the moves,
+drops, picked up boxes and journal events of the workers, and updates the
+distance fields, so the model in front of it, and the server, see a single
+model. With a single tile it steps exactly like the SimultaneousScheduler;
+with more, robots near the tile borders give up some moves (they can't follow
+another robot across a border or fall back to a cell across it), and loaded
+robots pick their drop zone from the queues at the start of the step.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import multiprocessing
+import threading
+import traceback
+import weakref
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+import numpy as np
+from RobotAgents import EMPTY, ROBOT
+from EventJournal import MOVE, PICKUP, DROP, BLOCKED
+from SimultaneousScheduler import Snapshot, propose, resolve, read_only, DROP_BOX, PICK_UP, MOVE_TO
+from Profiler import profiler
+
+# Cells read around a tile: the claimants of a cell next to the tile are one
+# cell away from it, and their proposals look one cell further
+HALO = 3
+
+def create_array(shape, dtype, blocks, spec, name):
+    '''Allocates a shared array, adds its block to blocks and its description to spec.'''
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create = True, size = max(1, int(np.prod(shape)) * dtype.itemsize))
+    blocks.append(block)
+    spec[name] = (block.name, shape, dtype.str)
+    return np.ndarray(shape, dtype, buffer = block.buf)
+
+def attach_arrays(spec, blocks):
+    '''Opens the shared arrays described by spec, from another process.'''
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        block = shared_memory.SharedMemory(name = block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype, buffer = block.buf)
+    return arrays
+
+def split(length, parts):
+    '''Bounds of parts nearly equal ranges covering range(length).'''
+    return [round(length * part / parts) for part in range(parts + 1)]
+
+def release(processes, connections, blocks):
+    '''Stops the workers and frees the shared memory; safe to call more than once.'''
+    for connection in connections:
+        try:
+            connection.send(("close",))
+        except (OSError, ValueError):
+            pass
+    for process in processes:
+        process.join(timeout = 5)
+        if process.is_alive():
+            process.terminate()
+    for connection in connections:
+        connection.close()
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            # An array still points to it; the mapping goes away with the process
+            pass
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+    processes.clear()
+    connections.clear()
+    blocks.clear()
+
+class TileWorker:
+    """
+    Steps the robots of one tile, in its worker process.
+    Attributes:
+        tile: Index of the tile, column * rows + row
+        bounds: (x0, x1, y0, y1) of the tile, the ends excluded
+        region: The bounds grown by HALO cells and clipped to the grid
+        cells: Private copy of the occupancy array; only the region is kept up to date
+    """
+    def __init__(self, spec, tile, barrier):
+        self.blocks = []
+        self.shared = attach_arrays(spec["arrays"], self.blocks)
+        self.barrier = barrier
+        self.tile = tile
+        self.rows = len(spec["row_bounds"]) - 1
+        self.queue_weight = spec["queue_weight"]
+        column_bounds, row_bounds = spec["column_bounds"], spec["row_bounds"]
+        column, row = divmod(tile, self.rows)
+        x0, x1, y0, y1 = column_bounds[column], column_bounds[column + 1], row_bounds[row], row_bounds[row + 1]
+        self.bounds = (x0, x1, y0, y1)
+        width, height = self.shared["cells"].shape
+        self.region = (max(0, x0 - HALO), min(width, x1 + HALO), max(0, y0 - HALO), min(height, y1 + HALO))
+        # Tile of every column and row, as lists since they are read one cell at a time
+        self.column_of = np.repeat(np.arange(len(column_bounds) - 1), np.diff(column_bounds)).tolist()
+        self.row_of = np.repeat(np.arange(self.rows), np.diff(row_bounds)).tolist()
+
+        self.cells = np.zeros((width, height), dtype = np.uint8)
+        self.drop_zones = tuple(spec["drop_zones"])
+        self.drop_distances = tuple(read_only(distances) for distances in self.shared["drop_distances"])
+        self.box_distances = read_only(self.shared["box_distances"])
+
+    def tile_of(self, cell):
+        return self.column_of[cell[0]] * self.rows + self.row_of[cell[1]]
+
+    def assign_drop_zone(self, pos, queues):
+        '''Same choice as RobotModel.assign_drop_zone, with the queues at the start of the step.'''
+        costs = [int(distances[pos]) + self.queue_weight * queue for distances, queue in zip(self.drop_distances, queues)]
+        return costs.index(min(costs))
+
+    def step(self, step, seed, queues):
+        '''Runs one step of the tile and returns what the coordinator merges.'''
+        shared = self.shared
+        x0, x1, y0, y1 = self.bounds
+        rx0, rx1, ry0, ry1 = self.region
+        self.cells[rx0:rx1, ry0:ry1] = shared["cells"][rx0:rx1, ry0:ry1]
+        robot_at = shared["robot_at"][rx0:rx1, ry0:ry1]
+        near_x, near_y = np.nonzero(robot_at >= 0)
+        slots = robot_at[near_x, near_y]
+        near_x += rx0
+        near_y += ry0
+        # Only the robots within two cells of the tile can claim a cell of the tile, or compete with its robots
+        near = (near_x >= x0 - 2) & (near_x < x1 + 2) & (near_y >= y0 - 2) & (near_y < y1 + 2)
+        slots, near_x, near_y = slots[near], near_x[near], near_y[near]
+        loaded = shared["has_box"][slots]
+        zones = shared["zone"][slots]
+        # The other workers write their tiles after this point
+        self.barrier.wait()
+
+        slots = slots.tolist()
+        states = list(zip(shared["ids"][slots].tolist(), near_x.tolist(), near_y.tolist(), loaded.tolist(), zones.tolist()))
+        snapshot = Snapshot(step, seed, read_only(self.cells), self.drop_zones, self.drop_distances, self.box_distances)
+        proposals = [propose(state, snapshot) for state in states]
+
+        # First choice of every robot; the cells claimed from another tile are settled first, by priority
+        tile_of = self.tile_of
+        tiles = [tile_of(state[1:3]) for state in states]
+        claims = {}
+        crossing = set()
+        for index, (action, cells) in enumerate(proposals):
+            tile = tiles[index]
+            if action == PICK_UP:
+                target = cells[0]
+            elif action == MOVE_TO:
+                local = tuple(cell for cell in cells if tile_of(cell) == tile)
+                if tile_of(cells[0]) != tile and snapshot.cells[cells[0]] == EMPTY:
+                    target = cells[0]
+                else:
+                    target = local[0] if local else None
+                proposals[index] = (MOVE_TO, local)
+                if target is None:
+                    continue
+            else:
+                continue
+            claims.setdefault(target, []).append(index)
+            if tile_of(target) != tile:
+                crossing.add(target)
+        winners = {}
+        for target in crossing:
+            claimants = claims[target]
+            # Claims this tile can't see whole, and doesn't need
+            if tile_of(target) != self.tile and all(tiles[index] != self.tile for index in claimants):
+                continue
+            winners[target] = min(claimants, key = lambda index: (not states[index][3], states[index][0]))
+
+        own = [index for index, tile in enumerate(tiles) if tile == self.tile]
+        actions = {}
+        staying = []
+        for target, winner in winners.items():
+            if tiles[winner] == self.tile:
+                actions[winner] = (proposals[winner][0], target)
+                if proposals[winner][0] == PICK_UP:
+                    staying.append(states[winner][1:3])
+        rest = [index for index in own if index not in actions]
+        granted, _ = resolve([states[index] for index in rest], [proposals[index] for index in rest], winners, staying)
+        actions.update(zip(rest, granted))
+
+        cells, robot_at, box_at = shared["cells"], shared["robot_at"], shared["box_at"]
+        has_box, zone, robot_x, robot_y = shared["has_box"], shared["zone"], shared["x"], shared["y"]
+        events = {MOVE: [], PICKUP: [], DROP: [], BLOCKED: []}
+        changed = []
+        picked_boxes = {}
+        arriving = []
+        moves = drops = migrations = 0
+        for index in own:
+            action, target = actions[index]
+            unique_id, x, y, _, _ = states[index]
+            slot = slots[index]
+            if action == DROP_BOX:
+                drops += 1
+                has_box[slot] = False
+                zone[slot] = -1
+                events[DROP].append((unique_id, *target))
+            elif action == PICK_UP:
+                has_box[slot] = True
+                zone[slot] = self.assign_drop_zone((x, y), queues)
+                events[PICKUP].append((unique_id, *target))
+                if tile_of(target) == self.tile:
+                    picked_boxes[int(box_at[target])] = target
+                    box_at[target] = -1
+                    cells[target] = EMPTY
+            elif action == MOVE_TO:
+                moves += 1
+                cells[x, y] = EMPTY
+                robot_at[x, y] = -1
+                robot_x[slot], robot_y[slot] = target
+                events[MOVE].append((unique_id, *target))
+                arriving.append((slot, target))
+                migrations += tile_of(target) != self.tile
+            else:
+                events[BLOCKED].append((unique_id, x, y))
+                continue
+            changed.append(unique_id)
+        # Robots and boxes of the other tiles that this tile granted a cell or a box to
+        for target, winner in winners.items():
+            if tile_of(target) != self.tile or tiles[winner] == self.tile:
+                continue
+            if proposals[winner][0] == PICK_UP:
+                picked_boxes[int(box_at[target])] = target
+                box_at[target] = -1
+                cells[target] = EMPTY
+            else:
+                arriving.append((slots[winner], target))
+        # Every cell left in the step is emptied before the robots arrive
+        for slot, target in arriving:
+            if tile_of(target) == self.tile:
+                cells[target] = ROBOT
+                robot_at[target] = slot
+
+        events = {kind: tuple(np.array(column, dtype = np.int64) for column in zip(*recorded))
+                  for kind, recorded in events.items() if recorded}
+        return moves, drops, changed, picked_boxes, events, migrations
+
+    def close(self):
+        self.shared = self.drop_distances = self.box_distances = None
+        for block in self.blocks:
+            block.close()
+
+def run_worker(spec, tile, barrier, connection):
+    '''Main function of a worker process: runs the steps the coordinator sends until it is closed.'''
+    worker = TileWorker(spec, tile, barrier)
+    try:
+        while True:
+            command = connection.recv()
+            if command[0] == "close":
+                break
+            connection.send(("ok", worker.step(*command[1:])))
+    except EOFError:
+        pass
+    except Exception:
+        # The other workers may be waiting for this one at the barrier
+        barrier.abort()
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        worker.close()
+
+class ShardedEngine:
+    """
+    Steps the robots of a RobotModel in one worker process per tile of the grid.
+    Attributes:
+        tiles: (columns, rows) the grid is split into
+        column_bounds, row_bounds: Edges of the tiles, the last one is the width or height of the grid
+        ids, x, y, has_box, zone: Robot arrays in shared memory, in unique_id order; the workers write them
+        box_field: DistanceField to the boxes still on the floor, followed by empty robots
+        seed: Seed of the tie breaks
+        migrations: Robots that moved to another tile in the last step
+    """
+    def __init__(self, model, tiles = (2, 2), seed = 0):
+        columns, rows = tiles
+        width, height = model.grid.width, model.grid.height
+        if not (0 < columns <= width and 0 < rows <= height):
+            raise ValueError(f"Can't split a {width}x{height} grid into {columns}x{rows} tiles")
+        self.model = model
+        self.tiles = (columns, rows)
+        self.seed = seed
+        self.migrations = 0
+        self.column_bounds, self.row_bounds = split(width, columns), split(height, rows)
+        self.robots = list(model.grid.registries["robot"].values())
+        self.box_field = model.box_distance_field()
+
+        self.blocks = []
+        arrays = {}
+        shape = (width, height)
+        cells = create_array(shape, np.uint8, self.blocks, arrays, "cells")
+        cells[:] = model.grid.cells
+        # The model's grid works on the shared occupancy array from now on
+        model.grid.cells = cells
+        self.ids = create_array(len(self.robots), np.int64, self.blocks, arrays, "ids")
+        self.x = create_array(len(self.robots), np.int64, self.blocks, arrays, "x")
+        self.y = create_array(len(self.robots), np.int64, self.blocks, arrays, "y")
+        self.has_box = create_array(len(self.robots), bool, self.blocks, arrays, "has_box")
+        self.zone = create_array(len(self.robots), np.int64, self.blocks, arrays, "zone")
+        self.ids[:] = [robot.unique_id for robot in self.robots]
+        self.x[:] = [robot.pos[0] for robot in self.robots]
+        self.y[:] = [robot.pos[1] for robot in self.robots]
+        self.has_box[:] = [robot.has_box for robot in self.robots]
+        self.zone[:] = [robot.zone if robot.zone is not None else -1 for robot in self.robots]
+        robot_at = create_array(shape, np.int32, self.blocks, arrays, "robot_at")
+        robot_at.fill(-1)
+        robot_at[self.x, self.y] = np.arange(len(self.robots))
+        box_at = create_array(shape, np.int32, self.blocks, arrays, "box_at")
+        box_at.fill(-1)
+        for box in model.grid.registries["box"].values():
+            box_at[box.pos] = box.unique_id
+        self.drop_distances = create_array((len(model.drop_fields),) + shape, np.int32, self.blocks, arrays, "drop_distances")
+        self.box_distances = create_array(shape, np.int32, self.blocks, arrays, "box_distances")
+        self.publish_distances()
+
+        spec = {"arrays": arrays, "column_bounds": self.column_bounds, "row_bounds": self.row_bounds,
+                "drop_zones": list(model.drop_zones), "queue_weight": model.queue_weight}
+        # spawn instead of fork: the server forks from a process with running threads
+        context = multiprocessing.get_context("spawn")
+        # Kept for as long as the workers run: the semaphores behind it go away with the last reference
+        self.barrier = context.Barrier(columns * rows)
+        self.processes, self.connections = [], []
+        for tile in range(columns * rows):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(target = run_worker, args = (spec, tile, self.barrier, worker_connection), daemon = True)
+            process.start()
+            worker_connection.close()
+            self.processes.append(process)
+            self.connections.append(connection)
+        # Reentrant: a failed step closes the engine while it holds the lock
+        self.lock = threading.RLock()
+        self.finalizer = weakref.finalize(self, release, self.processes, self.connections, self.blocks)
+
+    def publish_distances(self):
+        '''Copies the distance fields the workers read to shared memory.'''
+        for shared, field in zip(self.drop_distances, self.model.drop_fields):
+            shared[:] = field.distances
+        self.box_distances[:] = self.box_field.distances
+
+    def step(self):
+        '''Advance every robot one step.'''
+        model = self.model
+        with self.lock:
+            if not self.finalizer.alive:
+                raise RuntimeError("The sharded engine is closed")
+            phase = profiler.clock()
+            step = model.cant_steps
+            for connection in self.connections:
+                connection.send(("step", step, self.seed, list(model.zone_queues)))
+            results = self.gather()
+            phase = profiler.mark("ShardedEngine.workers", phase)
+
+            changed = []
+            picked_boxes = {}
+            self.migrations = 0
+            for moves, drops, robots, boxes, events, migrations in results:
+                model.total_moves += moves
+                model.boxes_dropped += drops
+                changed += robots
+                picked_boxes.update(boxes)
+                self.migrations += migrations
+                for kind, (agents, xs, ys) in events.items():
+                    model.journal.record_many(step, kind, agents, xs, ys)
+
+            boxes = model.grid.registries["box"]
+            for unique_id in sorted(picked_boxes):
+                model.remove_box(boxes[unique_id])
+            if picked_boxes:
+                self.box_field.rebuild()
+                self.publish_distances()
+            model.zone_queues = np.bincount(self.zone[self.has_box], minlength = len(model.drop_zones)).tolist()
+            model.changes.record(step + 1, robots = changed, boxes = picked_boxes)
+            profiler.mark("ShardedEngine.merge", phase)
+
+    def gather(self):
+        '''Waits for the result of every worker, in tile order.'''
+        results = [None] * len(self.connections)
+        pending = {connection: tile for tile, connection in enumerate(self.connections)}
+        while pending:
+            for connection in wait(list(pending)):
+                tile = pending.pop(connection)
+                try:
+                    status, value = connection.recv()
+                except (EOFError, OSError):
+                    status, value = "error", "the process exited"
+                if status == "error":
+                    self.close()
+                    raise RuntimeError(f"Worker of tile {tile} failed: {value}")
+                results[tile] = value
+        return results
+
+    def sync(self):
+        '''Moves the RobotAgent objects to the positions and loads in the shared arrays, e.g. before saving the model.'''
+        grid = self.model.grid
+        for robot in self.robots:
+            if grid.grid[robot.pos[0]][robot.pos[1]] is robot:
+                grid.grid[robot.pos[0]][robot.pos[1]] = None
+        for robot, x, y, has_box, zone in zip(self.robots, self.x.tolist(), self.y.tolist(),
+                                              self.has_box.tolist(), self.zone.tolist()):
+            robot.pos = (x, y)
+            grid.grid[x][y] = robot
+            robot.has_box = has_box
+            robot.zone = zone if zone >= 0 else None
+        xs, ys = np.nonzero(grid.cells == EMPTY)
+        grid.empties = set(zip(xs.tolist(), ys.tolist()))
+
+    def close(self):
+        '''Stops the workers. The model keeps private copies of the shared arrays, and can't be stepped anymore.'''
+        with self.lock:
+            if not self.finalizer.alive:
+                return
+            self.model.grid.cells = self.model.grid.cells.copy()
+            self.ids, self.x, self.y = self.ids.copy(), self.x.copy(), self.y.copy()
+            self.has_box, self.zone = self.has_box.copy(), self.zone.copy()
+            self.drop_distances = self.box_distances = None
+            self.finalizer()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Simultaneous activation scheduler for the warehouse robots.
+
+With mesa's BaseScheduler robot i already sees the moves of robots 0..i-1,
+so the outcome depends on the order of the robots. This scheduler steps
+every robot against the same frozen state instead, in two phases:
+
+    1. Proposal: propose() decides the action of one robot (drop, pick up,
+       move or stay) from a read-only Snapshot of the start of the step. A
+       move lists every cell the robot could walk to, best first, including
+       the cells of other robots. propose() is a pure module level function,
+       so the proposals can be computed with any map: the builtin one, a
+       batched one or Pool.map.
+    2. Resolution: resolve() grants each box and each cell to a single robot,
+       loaded robots first and then the lowest unique_id. A robot may follow
+       another one into the cell it leaves, but robots that would swap places
+       (or go around in a cycle) wait for each other, and then all of them
+       fall back to their next cell. The granted actions are applied to the
+       model in unique_id order.
+
+Ties between equally good cells are broken with a hash of the seed, the step
+and the unique_id, so the result doesn't depend on the order in which the
+proposals are computed.
+
+Empty robots walk down a distance field to the boxes still on the floor
+(like the FleetEngine) instead of claiming boxes, since claims would make
+one robot's decision depend on the ones taken before it.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+from functools import partial
+from mesa.time import BaseScheduler
+from RobotAgents import EMPTY, BOX, ROBOT, UNREACHABLE
+from EventJournal import MOVE, PICKUP, DROP, BLOCKED
+
+STAY, DROP_BOX, PICK_UP, MOVE_TO = range(4)
+MASK = (1 << 64) - 1
+
+def tie_break(seed, step, unique_id, index):
+    '''Pseudo-random fraction in [0, 1) that only depends on its arguments (splitmix64).'''
+    value = (seed ^ (step * 0x9E3779B97F4A7C15) ^ (unique_id << 20) ^ index) & MASK
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK
+    return ((value ^ (value >> 31)) >> 11) / (1 << 53)
+
+def read_only(array):
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+class Snapshot:
+    """
+    Frozen state of the warehouse at the start of a step, everything propose() may read.
+    Attributes:
+        step, seed: Inputs of the tie breaks
+        cells: Read-only copy of the occupancy array
+        drop_zones: Cell of each drop zone
+        drop_distances: Read-only distance array to each drop zone
+        box_distances: Read-only distance array to the closest box on the floor
+    """
+    def __init__(self, step, seed, cells, drop_zones, drop_distances, box_distances):
+        self.step = step
+        self.seed = seed
+        self.cells = cells
+        self.drop_zones = drop_zones
+        self.drop_distances = drop_distances
+        self.box_distances = box_distances
+
+    @classmethod
+    def of_model(cls, model, box_field, seed):
+        return cls(model.cant_steps, seed, read_only(model.grid.cells.copy()), tuple(model.drop_zones),
+                   tuple(read_only(field.distances) for field in model.drop_fields), read_only(box_field.distances))
+
+def propose(robot, snapshot):
+    '''
+    Returns the (action, cells) one robot wants; it doesn't change anything.
+    cells is the drop zone or the box for DROP_BOX and PICK_UP, the candidate cells,
+    best first, for MOVE_TO, and empty for STAY.
+    Args:
+        robot: (unique_id, x, y, has_box, zone) of the robot, zone is -1 for robots without a box
+        snapshot: Snapshot of the step
+    '''
+    unique_id, x, y, has_box, zone = robot
+    cells = snapshot.cells
+    # Von Neumann neighbourhood, in the same order as mesa's get_neighborhood; the border keeps it inside the grid
+    neighbours = ((x - 1, y), (x, y - 1), (x, y + 1), (x + 1, y))
+    if has_box and snapshot.drop_zones[zone] in neighbours:
+        return DROP_BOX, (snapshot.drop_zones[zone],)
+    if not has_box:
+        for cell in neighbours:
+            if cells[cell] == BOX:
+                return PICK_UP, (cell,)
+
+    distances = snapshot.drop_distances[zone] if has_box else snapshot.box_distances
+    candidates = []
+    for index, cell in enumerate(neighbours):
+        state = cells[cell]
+        if state != EMPTY and state != ROBOT:
+            continue
+        # Cells without a path to the goal go last
+        distance = distances[cell]
+        candidates.append(((distance == UNREACHABLE, int(distance), tie_break(snapshot.seed, snapshot.step, unique_id, index)), cell))
+    if not candidates:
+        return STAY, ()
+    candidates.sort()
+    return MOVE_TO, tuple(cell for _, cell in candidates)
+
+def resolve(robots, proposals, taken = (), staying = ()):
+    '''
+    Returns the granted (action, cell) of every robot, where cell is the drop zone, box or
+    cell it moves to and robots that got nothing are turned into (STAY, None), and the
+    indices of the moving robots in an order that leaves every cell before it is entered.
+    Args:
+        robots: (unique_id, x, y, has_box, zone) of every robot
+        proposals: What propose() returned for each robot
+        taken: Boxes and cells already granted to robots that are not in robots
+        staying: Cells of robots that are not in robots and stay where they are
+    '''
+    granted = [(STAY, None)] * len(robots)
+    moves = []
+    order = sorted(range(len(robots)), key = lambda i: (not robots[i][3], robots[i][0]))
+    # Cells of the robots that will still be in their cell at the end of the step
+    staying = set(staying)
+    taken = set(taken)
+    waiting = []
+    for index in order:
+        action, cells = proposals[index]
+        if action == PICK_UP and cells[0] not in taken:
+            taken.add(cells[0])
+            granted[index] = (PICK_UP, cells[0])
+        elif action == DROP_BOX:
+            granted[index] = (DROP_BOX, cells[0])
+        elif action == MOVE_TO:
+            waiting.append(index)
+            continue
+        staying.add(robots[index][1:3])
+
+    # Each robot takes its best cell that is free, waiting while the robot in it may still leave
+    choice = dict.fromkeys(waiting, 0)
+    occupied = {robot[1:3] for robot in robots}
+    vacated = set()
+    while waiting:
+        progress = False
+        still_waiting = []
+        for index in waiting:
+            cells = proposals[index][1]
+            origin = robots[index][1:3]
+            while choice[index] < len(cells):
+                cell = cells[choice[index]]
+                if cell in taken or cell in staying:
+                    choice[index] += 1
+                elif cell in vacated or cell not in occupied:
+                    taken.add(cell)
+                    vacated.add(origin)
+                    granted[index] = (MOVE_TO, cell)
+                    moves.append(index)
+                    progress = True
+                    break
+                else:
+                    still_waiting.append(index)
+                    break
+            else:
+                staying.add(origin)
+                progress = True
+        waiting = still_waiting
+        if not progress:
+            # Swaps and cycles: every robot left waits for another one, so all of them try their next cell
+            for index in waiting:
+                choice[index] += 1
+    return granted, moves
+
+class SimultaneousScheduler(BaseScheduler):
+    """
+    Steps every robot of a RobotModel against the same snapshot.
+    Attributes:
+        box_field: DistanceField to the boxes still on the floor, followed by empty robots
+        seed: Seed of the tie breaks
+        map: Function used like the builtin map to compute the proposals (for example Pool.map)
+    """
+    def __init__(self, model, agents = (), seed = 0, map = map):
+        super().__init__(model)
+        for agent in agents:
+            self.add(agent)
+        self.seed = seed
+        self.map = map
+        self.box_field = model.box_distance_field()
+
+    def robot_states(self):
+        '''(unique_id, x, y, has_box, zone) of every robot, in unique_id order.'''
+        robots = sorted(self._agents.values(), key = lambda robot: robot.unique_id)
+        return robots, [(robot.unique_id, robot.pos[0], robot.pos[1], robot.has_box,
+                         robot.zone if robot.zone is not None else -1) for robot in robots]
+
+    def step(self):
+        robots, states = self.robot_states()
+        snapshot = Snapshot.of_model(self.model, self.box_field, self.seed)
+        proposals = list(self.map(partial(propose, snapshot = snapshot), states))
+        self.apply(robots, *resolve(states, proposals))
+        self.steps += 1
+        self.time += 1
+
+    def apply(self, robots, actions, moves):
+        '''Applies the granted actions to the model in unique_id order, and then the moves in the order given.'''
+        model = self.model
+        grid = model.grid
+        journal = model.journal
+        step = model.cant_steps
+        picked_boxes = {}
+        changed = []
+        for robot, (action, cell) in zip(robots, actions):
+            if action == DROP_BOX:
+                model.boxes_dropped += 1
+                robot.has_box = False
+                model.release_drop_zone(robot.zone)
+                robot.zone = None
+                journal.record(step, DROP, robot.unique_id, *cell)
+            elif action == PICK_UP:
+                box = grid[cell[0]][cell[1]]
+                picked_boxes[box.unique_id] = model.remove_box(box)
+                robot.has_box = True
+                robot.zone = model.assign_drop_zone(robot.pos)
+                journal.record(step, PICKUP, robot.unique_id, *cell)
+            elif action == MOVE_TO:
+                model.total_moves += 1
+                journal.record(step, MOVE, robot.unique_id, *cell)
+            else:
+                journal.record(step, BLOCKED, robot.unique_id, *robot.pos)
+                continue
+            changed.append(robot.unique_id)
+        for index in moves:
+            grid.move_agent(robots[index], actions[index][1])
+        if picked_boxes:
+            self.box_field.rebuild()
+        model.changes.record(step + 1, robots = changed, boxes = picked_boxes)
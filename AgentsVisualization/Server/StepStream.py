@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Push-based stream of simulation steps.
+
+A StepStream steps the model in a background thread at a fixed tick rate and
+wakes up its subscribers after every step. Subscribers don't get a queue of
+frames: each one remembers the last step it sent and, when it is ready for
+more, asks for everything that changed since then. A slow client therefore
+gets a single coalesced frame covering all the steps it missed, and memory
+does not grow with the number of slow clients.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import threading
+import time
+
+class StepStream:
+    """
+    Background stepping plus the subscriber side of the stream.
+    Attributes:
+        advance: Function that runs one step and returns the (step, running) of the model
+        changes: Function from the last step a subscriber has (None for none) to the (step, payload) to send it;
+            it is called without the lock, so it must not read the model while it is being stepped
+        rate: Steps per second
+        step: Last step run by the stream
+        stopped: True once the model finished or the stream was stopped
+        lock: Held while stepping, shared with whatever else steps the model
+    """
+    def __init__(self, advance, changes, step = 0, rate = 10.0, lock = None):
+        self.advance = advance
+        self.changes = changes
+        self.rate = rate
+        self.step = step
+        self.stopped = False
+        self.lock = lock if lock is not None else threading.Lock()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target = self.run, daemon = True)
+            self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def run(self):
+        next_tick = time.perf_counter()
+        try:
+            while not self.stopped:
+                with self.lock:
+                    if self.stopped:
+                        break
+                    step, running = self.advance()
+                with self.condition:
+                    self.step = step
+                    if not running:
+                        self.stopped = True
+                    self.condition.notify_all()
+                next_tick += 1.0 / self.rate
+                time.sleep(max(0.0, next_tick - time.perf_counter()))
+        finally:
+            # Also when advance raises, so subscribers return and the session can step or be evicted again
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+
+    def subscribe(self, since = None, timeout = 15.0):
+        '''
+        Yields the payload for every change after since (None for a full first payload).
+        Yields None when nothing happened for timeout seconds, so the caller can send a keep-alive.
+        '''
+        sent = since
+        while True:
+            with self.condition:
+                if sent is not None and self.step <= sent and not self.stopped:
+                    self.condition.wait(timeout)
+                step, stopped = self.step, self.stopped
+            if sent is not None and step <= sent:
+                if stopped:
+                    return
+                yield None
+                continue
+            sent, payload = self.changes(sent)
+            yield payload
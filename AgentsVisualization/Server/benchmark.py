@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the warehouse model.
+
+Without options, times the construction of RobotModel for dense
+configurations, where most of the interior cells end up with a shelf, a box
+or a robot.
+
+With --scaling, runs the scaling suite: starting from a base configuration it
+sweeps the number of robots, the grid size, the shelf density and the number
+of boxes, one at a time, with fixed seeds. Every case reports its setup time,
+steps per second, peak memory (traced in a separate run, so the tracing
+doesn't slow down the timed one) and boxes delivered per 100 steps. The
+results are written as JSON with --output, and --compare checks them against
+a stored baseline: the exit code is 1 if any case got slower, bigger or
+delivers fewer boxes than the tolerance allows.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --scaling --output baseline.json
+    python benchmark.py --scaling --engine vectorized --compare baseline.json --tolerance 0.2
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from RobotAgents import RobotModel
+
+# (N, max_shelves, N_boxes, width, height); the last ones fill about 90% of the floor
+SETUP_CONFIGURATIONS = [
+    (10, 5, 10, 28, 28),
+    (200, 200, 200, 50, 50),
+    (1000, 400, 1900, 60, 60),
+    (3000, 1000, 5000, 100, 100),
+    (12000, 4000, 22000, 200, 200),
+]
+
+# Every case of the scaling suite changes one parameter of the base configuration
+SCALING_BASE = {"N": 100, "max_shelves": 100, "N_boxes": 200, "width": 60, "height": 60}
+SCALING_AXES = {
+    "robots": ("N", [25, 100, 400, 1600]),
+    "grid": ("width", [30, 60, 120, 240]),
+    "shelves": ("shelf_density", [0.0, 0.1, 0.2, 0.4]),
+    "boxes": ("N_boxes", [50, 200, 800, 2000]),
+}
+# Relative change allowed by --compare before a case is flagged
+TOLERANCE = 0.15
+
+def time_setup(N, max_shelves, N_boxes, width, height, repeats = 3, seed = 0):
+    '''Returns the best construction time, in seconds, out of repeats runs.'''
+    best = float("inf")
+    for i in range(repeats):
+        start = time.perf_counter()
+        RobotModel(N, max_shelves, N_boxes, width, height, 0, seed = seed + i)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def scaling_cases():
+    '''Returns the (name, parameters) of every case of the scaling suite.'''
+    cases = []
+    for axis, (parameter, values) in SCALING_AXES.items():
+        for value in values:
+            parameters = dict(SCALING_BASE)
+            if parameter == "shelf_density":
+                # max_shelves is an upper bound, the model picks a random amount below it
+                parameters["max_shelves"] = max(1, int(value * (parameters["width"] - 2) * (parameters["height"] - 2)))
+            elif parameter == "width":
+                parameters["width"] = parameters["height"] = value
+            else:
+                parameters[parameter] = value
+            cases.append((f"{axis}-{value}", parameters))
+    return cases
+
+def run_case(parameters, steps = 100, engine = "agents", seed = 0, repeats = 3):
+    '''
+    Times one case of the scaling suite and returns its results.
+    Args:
+        parameters: N, max_shelves, N_boxes, width and height of the model
+        steps: Steps run; the model never stops on max_moves, only when every box is delivered
+        repeats: Timed runs with the same seed; the best one is reported
+    '''
+    arguments = (parameters["N"], parameters["max_shelves"], parameters["N_boxes"], parameters["width"], parameters["height"])
+    best_setup, best_rate = float("inf"), 0.0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model = RobotModel(*arguments, sys.maxsize, engine = engine, seed = seed)
+        setup = time.perf_counter() - start
+        start = time.perf_counter()
+        steps_run = model.advance(steps)
+        elapsed = time.perf_counter() - start
+        best_setup = min(best_setup, setup)
+        best_rate = max(best_rate, steps_run / elapsed if elapsed > 0 else 0.0)
+
+    tracemalloc.start()
+    traced = RobotModel(*arguments, sys.maxsize, engine = engine, seed = seed)
+    traced.advance(steps)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"parameters": dict(parameters, engine = engine, seed = seed, steps = steps),
+            "steps_run": steps_run, "setup_seconds": best_setup, "steps_per_second": best_rate,
+            "peak_memory_bytes": peak, "boxes_per_100_steps": 100 * model.boxes_dropped / steps_run if steps_run else 0.0}
+
+def run_scaling(steps = 100, engine = "agents", seed = 0, repeats = 3, only = None):
+    '''Runs the scaling suite, or the cases whose name starts with one of only, and returns the JSON document.'''
+    # Untimed run, so the first case doesn't pay for the imports and caches
+    RobotModel(10, 5, 10, 28, 28, sys.maxsize, engine = engine, seed = seed).advance(10)
+    results = {}
+    for name, parameters in scaling_cases():
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        results[name] = run_case(parameters, steps, engine, seed, repeats)
+        print(format_case(name, results[name]), flush = True)
+    return {"environment": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                            "platform": platform.platform(), "date": time.strftime("%Y-%m-%dT%H:%M:%S")},
+            "results": results}
+
+def format_case(name, result):
+    return (f"{name:<14} {result['setup_seconds'] * 1000:>10.1f} {result['steps_per_second']:>10.1f} "
+            f"{result['peak_memory_bytes'] / 2**20:>10.1f} {result['boxes_per_100_steps']:>10.2f}")
+
+# (key, label, True if higher is better)
+COMPARED = [("steps_per_second", "steps/s", True), ("setup_seconds", "setup", False),
+            ("peak_memory_bytes", "memory", False), ("boxes_per_100_steps", "boxes/100", True)]
+
+def compare(current, baseline, tolerance = TOLERANCE):
+    '''
+    Returns the (case, metric, baseline value, current value, relative change) of every result
+    worse than the baseline by more than tolerance. Cases run with other parameters are skipped.
+    '''
+    regressions = []
+    for name, result in current["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None or reference["parameters"] != result["parameters"]:
+            continue
+        for key, label, higher_is_better in COMPARED:
+            before, after = reference[key], result[key]
+            if before == 0:
+                continue
+            change = (after - before) / before
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((name, label, before, after, change))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmarks for the warehouse model.")
+    parser.add_argument("--scaling", action = "store_true", help = "run the scaling suite instead of the setup times")
+    parser.add_argument("--steps", type = int, default = 100)
+    parser.add_argument("--engine", default = "agents", choices = ["agents", "vectorized", "simultaneous", "sharded"])
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--repeats", type = int, default = 3)
+    parser.add_argument("--only", nargs = "+", help = "cases to run, by name prefix (robots, grid-120, ...)")
+    parser.add_argument("--output", help = "JSON file for the results")
+    parser.add_argument("--compare", help = "JSON baseline written by a previous --output")
+    parser.add_argument("--tolerance", type = float, default = TOLERANCE)
+    args = parser.parse_args()
+
+    if not args.scaling:
+        print(f"{'N':>7} {'shelves':>8} {'boxes':>7} {'width':>6} {'height':>6} {'fill':>6} {'setup (ms)':>11}")
+        for N, max_shelves, N_boxes, width, height in SETUP_CONFIGURATIONS:
+            # max_shelves is an upper bound, the model picks a random amount below it
+            fill = (N + max_shelves / 2 + N_boxes) / ((width - 2) * (height - 2))
+            seconds = time_setup(N, max_shelves, N_boxes, width, height)
+            print(f"{N:>7} {max_shelves:>8} {N_boxes:>7} {width:>6} {height:>6} {fill:>6.0%} {seconds * 1000:>11.1f}")
+        sys.exit()
+
+    print(f"{'case':<14} {'setup (ms)':>10} {'steps/s':>10} {'peak (MB)':>10} {'boxes/100':>10}")
+    document = run_scaling(args.steps, args.engine, args.seed, args.repeats, args.only)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(document, file, indent = 2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(document, json.load(file), args.tolerance)
+        for name, label, before, after, change in regressions:
+            print(f"REGRESSION {name:<14} {label:<10} {before:>12.4g} -> {after:<12.4g} ({change:+.0%})")
+        if not regressions:
+            print(f"No regressions over {args.tolerance:.0%}")
+        sys.exit(1 if regressions else 0)
@@ -2,8 +2,19 @@
 # Python flask server to interact with Unity. Based on the code provided by Sergio Ruiz.
 # Octavio Navarro. October 2021
 
-from flask import Flask, request, jsonify
+import argparse
+import hashlib
+import json
+import os
+import time
+from flask import Flask, Response, abort, make_response, request, jsonify
 from RobotAgents import *
+from RobotFrame import FRAME_MIMETYPE, encode_frame
+from StepStream import StepStream
+from SessionRegistry import SessionRegistry, model_bytes, view_bytes
+from LookAhead import LookAhead
+from ModelView import ModelView
+from Metrics import MetricsRegistry, instrument_app
 
 # Default elements of the model:
 
@@ -12,56 +23,321 @@ max_shelves = 5
 number_boxes = 10
 width = 28
 height = 28
-currentStep = 0
 max_steps = 100
+number_drop_zones = 1
+# Step engine of RobotModel; "sharded" splits the grid into tiles ("columns x rows") stepped by worker processes
+step_engine = "agents"
+tiles = "2x2"
+# Most tiles, each one a worker process, a sharded session may ask for: one per core, and at least the default 2x2
+max_tiles = max(os.cpu_count() or 1, 4)
+# Most steps a lookAhead session may keep computed ahead of its client; every one is a ModelView
+max_look_ahead = 64
+
+# Every client has its own model; requests name it with the session parameter. Requests
+# are served by several threads: one at a time steps a model, holding its session lock,
+# and every read is answered from the session's last ModelView without waiting for it
+sessions = SessionRegistry()
 
 app = Flask("Warehouse example")
 
+# Served at /metrics; the request series of every route are added by instrument_app below
+metrics = MetricsRegistry()
+step_seconds = metrics.histogram("warehouse_step_duration_seconds", "Time to run RobotModel.step")
+
+def liveViews():
+    with sessions.lock:
+        return [session.view for session in sessions.sessions.values() if session.view is not None]
+
+def sessionsMemory():
+    with sessions.lock:
+        return sum(session.size for session in sessions.sessions.values())
+
+metrics.gauge("warehouse_sessions", "Live sessions", lambda: len(sessions.sessions))
+metrics.gauge("warehouse_models_running", "Models that haven't finished", lambda: sum(view.running for view in liveViews()))
+metrics.gauge("warehouse_session_memory_bytes", "Estimated memory of the models of every session", sessionsMemory)
+metrics.gauge("warehouse_agents", "Agents in every model, by tag", lambda: sum(len(view.ids) for view in liveViews()), {"tag": "robot"})
+metrics.gauge("warehouse_agents", "Agents in every model, by tag", lambda: sum(len(view.boxes) for view in liveViews()), {"tag": "box"})
+
 # @app.route('/', methods=['POST', 'GET'])
 
 @app.route('/init', methods=['POST', 'GET'])
 def initModel():
-    global currentStep, warehouse_model, number_agents, max_shelves, number_boxes, width, height, max_steps
-
     if request.method == 'POST':
-        number_agents = int(request.form.get('NAgents'))
-        number_boxes = int(request.form.get('NBoxes'))
-        width = int(request.form.get('width'))
-        height = int(request.form.get('height'))
-        max_shelves = int(request.form.get('maxShelves'))
-        max_steps = int(request.form.get('maxSteps'))
-        currentStep = 0
-        warehouse_model = RobotModel(number_agents, max_shelves, number_boxes, width, height, max_steps)
-        return jsonify({"message":"Parameters recieved, model initiated."})
+        # A new session, or the one named in the form to start it over; requests
+        # without a session go to the last one created without a name
+        try:
+            # Optional lookAhead=N: a background worker keeps up to N steps computed ahead of the
+            # client. A new /init of the session replaces the session, which drops the old buffer
+            look_ahead = min(max(int(request.form.get('lookAhead', 0)), 0), max_look_ahead)
+            engine = request.form.get('engine', step_engine)
+            columns, rows = (int(count) for count in request.form.get('tiles', tiles).split('x'))
+            if engine == "sharded" and columns * rows > max_tiles:
+                raise ValueError(f"{columns}x{rows} tiles would start {columns * rows} worker processes, "
+                                 f"the server allows {max_tiles}")
+            model = RobotModel(int(request.form.get('NAgents', number_agents)), int(request.form.get('maxShelves', max_shelves)),
+                               int(request.form.get('NBoxes', number_boxes)), int(request.form.get('width', width)),
+                               int(request.form.get('height', height)), int(request.form.get('maxSteps', max_steps)),
+                               N_drop_zones = int(request.form.get('NDropZones', number_drop_zones)),
+                               engine = engine, tiles = (columns, rows))
+        except ValueError as error:
+            # Parameters that can't be read, or that don't fit the grid
+            return jsonify({'error': str(error)}), 400
+        session_id = request.form.get('session')
+        session = sessions.create(session_id)
+        if session_id is None:
+            sessions.default_id = session.session_id
+        session.layout_bytes, session.layout_etag = encodeLayout(model)
+        session.view = ModelView(model, 0, {})
+        model.step_observer = step_seconds.observe
+        session.model = model
+        if look_ahead > 0:
+            session.look_ahead = LookAhead(model, look_ahead)
+        # The buffered frames count against the memory cap as well
+        sessions.resize(session, model_bytes(model) + look_ahead * view_bytes(session.view))
+        return jsonify({"message":"Parameters recieved, model initiated.", "session": session.session_id})
 
     elif request.method == 'GET':
-        return jsonify({'drop_zone_pos': [{"x": warehouse_model.drop_zone[0], "y": warehouse_model.drop_zone[1]}]})
+        warehouse_model = currentSession().model
+        return jsonify({'drop_zone_pos': [{"x": x, "y": y} for (x, y) in warehouse_model.drop_zones]})
+
+def badRequest(message):
+    '''Ends the request with a 400 that has the message as its JSON error.'''
+    abort(make_response(jsonify({'error': message}), 400))
+
+def queryNumber(name, kind, default = None):
+    '''Reads the query parameter with kind (int or float), default if it is missing; a 400 if it can't be read.'''
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return kind(value)
+    except ValueError:
+        badRequest(f"{name} must be {'an integer' if kind is int else 'a number'}")
+
+def currentSession():
+    '''Session named by the session parameter of the request, or the default one.'''
+    session = sessions.get(request.values.get('session'))
+    if session is None or session.model is None:
+        abort(make_response(jsonify({'error': 'Unknown or expired session'}), 404))
+    return session
+
+def obstacleAttributes(obstacle):
+    return {"x": obstacle.pos[0], "y":1, "z": obstacle.pos[1], "tag": obstacle.tag, "picked_up": obstacle.picked_up, "unique_id": obstacle.unique_id}
+
+def encodeLayout(model):
+    '''The borders and shelves never change after init, so they are encoded once per model.'''
+    layout = {'width': model.grid.width, 'height': model.grid.height,
+              'obstacles_attributes': [obstacleAttributes(a) for tag in ("border", "shelf") for a in model.grid.registries[tag].values()]}
+    encoded = json.dumps(layout, separators=(',', ':')).encode()
+    return encoded, hashlib.sha1(encoded).hexdigest()
+
+@app.route('/getLayout', methods=['GET'])
+def getLayout():
+    if request.method == 'GET':
+        session = currentSession()
+        if session.layout_etag in request.if_none_match:
+            return Response(status=304, headers={'ETag': f'"{session.layout_etag}"'})
+        # no-cache: clients keep the layout but check the ETag, since a new /init changes it
+        return Response(session.layout_bytes, mimetype='application/json',
+                        headers={'ETag': f'"{session.layout_etag}"', 'Cache-Control': 'no-cache'})
+
+def wantsFrame():
+    '''True if the client asked for packed binary frames (see RobotFrame) instead of JSON.'''
+    return request.accept_mimetypes.best_match(['application/json', FRAME_MIMETYPE]) == FRAME_MIMETYPE
+
+def frameResponse(view, boxes = (), full = False):
+    '''Frame with every robot of the view, plus the given boxes as (unique_id, (x, z)) pairs.'''
+    boxes = list(boxes)
+    frame = encode_frame(view.current_step, view.dropped_boxes, view.running, view.ids, view.x, view.y, view.has_box,
+                         [unique_id for unique_id, _ in boxes], [pos[0] for _, pos in boxes],
+                         [pos[1] for _, pos in boxes], full)
+    return Response(frame, mimetype=FRAME_MIMETYPE)
 
 @app.route('/getRobotAgents', methods=['GET'])
 def getAgents():
-    global warehouse_model
-
     if request.method == 'GET':
-        robots_attributes = sorted([{"x": x, "y": 1, "z": z, "has_box": a.has_box, "unique_id": a.unique_id} for (a, x, z) in warehouse_model.grid.coord_iter() if isinstance(a, RobotAgent)], key=lambda item: item["unique_id"])
-        for robot_attributes in robots_attributes:
-            print(robot_attributes)
-        return jsonify({'robots_attributes': robots_attributes})
+        view = currentSession().view
+        if wantsFrame():
+            return frameResponse(view)
+        return jsonify({'robots_attributes': view.robots_attributes()})
 
 @app.route('/getObstacles', methods=['GET'])
 def getObstacles():
-    global warehouse_model
+    if request.method == 'GET':
+        view = currentSession().view
+        # Only the boxes, the borders and shelves come from /getLayout
+        return jsonify({'obstacles_attributes': view.boxes_attributes()})
+
+def changesPayload(session, since):
+    '''
+    Returns the step of the session's view and the robots and boxes changed after since, or
+    every robot and box when since is None or older than the change log remembers.
+    '''
+    view = session.view
+    # Steps the model already ran past the view (look-ahead, a step in progress) are left out
+    changed = session.model.changes.changed_since(since, view.step) if since is not None else None
+    # Progress of the run, so subscribers can tell a finished model from a stalled one
+    payload = {'step': view.step, 'droppedBoxes': view.dropped_boxes, 'running': view.running}
+    if changed is None:
+        payload.update({'full': True, 'robots_attributes': view.robots_attributes(),
+                        'obstacles_attributes': view.boxes_attributes()})
+    else:
+        robot_ids, box_ids = changed
+        payload.update({'full': False, 'robots_attributes': view.robots_attributes(robot_ids),
+                        'picked_boxes': sorted(box_ids)})
+    return view.step, payload
 
+@app.route('/getChanges', methods=['GET'])
+def getChanges():
     if request.method == 'GET':
-        obstaclePositions = sorted([{"x": x, "y":1, "z":z, "tag":a.tag, "picked_up": a.picked_up, "unique_id": a.unique_id}  for (a, x, z) in warehouse_model.grid.coord_iter() if isinstance(a, ObstacleAgent)], key=lambda item: item["unique_id"])
-        return jsonify({'obstacles_attributes':obstaclePositions})
+        session = currentSession()
+        # ?since=step: the robots and boxes changed after that step, or every robot and
+        # box when the client is further behind than the change log remembers
+        _, payload = changesPayload(session, queryNumber('since', int))
+        return jsonify(payload)
+
+def advanceModel(session):
+    '''
+    Steps the model of the session as asked in the query string.
+    Returns the steps run, the boxes picked up in them (None if the change log doesn't
+    remember them) and the new view of the session.
+    '''
+    if session.stream is not None and not session.stream.stopped:
+        # The stream owns the stepping while it runs
+        return 0, {}, session.view
+    # Optional fast-forward: ?steps=N, ?until=done and/or ?budget=seconds
+    steps = queryNumber('steps', int, 1)
+    until_done = request.args.get('until') == 'done'
+    budget = queryNumber('budget', float)
+    if budget is not None and not budget >= 0:
+        badRequest("budget must be a number of seconds, 0 or more")
+    # Only one request steps the model at a time; the others keep reading the last view
+    with session.lock:
+        if session.look_ahead is not None:
+            steps_run, picked_boxes = advanceLookAhead(session.look_ahead, steps, until_done, budget)
+            session.current_step += steps_run
+            session.view = session.look_ahead.last
+        else:
+            model = session.model
+            since = model.cant_steps
+            steps_run = model.advance(steps, until_done, budget)
+            changed = model.changes.changed_since(since, model.cant_steps)
+            picked_boxes = changed[1] if changed is not None else None
+            session.current_step += steps_run
+            session.view = ModelView(model, session.current_step, picked_boxes)
+        return steps_run, picked_boxes, session.view
+
+def advanceLookAhead(look_ahead, steps = 1, until_done = False, budget = None):
+    '''
+    Same as RobotModel.advance, but takes the steps from the look-ahead buffer.
+    Returns the steps taken and the boxes picked up in them (None if a frame didn't know them).
+    '''
+    deadline = time.perf_counter() + budget if budget is not None else None
+    count = 0
+    picked_boxes = {}
+    while look_ahead.last.running and (until_done or count < steps):
+        if count and deadline is not None and time.perf_counter() >= deadline:
+            break
+        frame = look_ahead.next_frame()
+        if frame is None:
+            break
+        if frame.picked_boxes is None:
+            picked_boxes = None
+        elif picked_boxes is not None:
+            picked_boxes.update(frame.picked_boxes)
+        count += 1
+    return count, picked_boxes
 
 @app.route('/update', methods=['GET'])
 def updateModel():
-    global currentStep, warehouse_model
     if request.method == 'GET':
-        warehouse_model.step()
-        currentStep += 1
-        return jsonify({'currentStep':currentStep, 'droppedBoxes': warehouse_model.boxes_dropped})
+        session = currentSession()
+        start = time.perf_counter()
+        steps_run, _, view = advanceModel(session)
+        return jsonify({'currentStep':view.current_step, 'droppedBoxes': view.dropped_boxes,
+                        'stepsRun': steps_run, 'totalMoves': view.total_moves,
+                        'running': view.running, 'elapsed': time.perf_counter() - start})
+
+@app.route('/tick', methods=['GET'])
+def tickModel():
+    if request.method == 'GET':
+        # /update, /getRobotAgents and the boxes picked up in this tick, in one response
+        session = currentSession()
+        steps_run, picked_boxes, view = advanceModel(session)
+        if wantsFrame():
+            if picked_boxes is not None:
+                return frameResponse(view, sorted(picked_boxes.items()))
+            return frameResponse(view, sorted(view.boxes.items()), full=True)
+        if picked_boxes is not None:
+            obstacles = view.boxes_attributes(picked_boxes, picked_up=True)
+        else:
+            # Fast-forwarded past the change log: every box still on the floor instead
+            obstacles = view.boxes_attributes()
+        return jsonify({'currentStep': view.current_step, 'droppedBoxes': view.dropped_boxes, 'stepsRun': steps_run,
+                        'running': view.running, 'full': picked_boxes is None,
+                        'robots_attributes': view.robots_attributes(), 'obstacles_attributes': obstacles})
+
+def streamAdvance(session):
+    '''Runs one step for the stream, which holds the session lock, and returns the (step, running) of the model.'''
+    model = session.model
+    since = model.cant_steps
+    session.current_step += model.advance(1)
+    changed = model.changes.changed_since(since, model.cant_steps)
+    session.view = ModelView(model, session.current_step, changed[1] if changed is not None else None)
+    return model.cant_steps, model.running
+
+@app.route('/stream', methods=['GET'])
+def streamSteps():
+    if request.method == 'GET':
+        # Server-Sent Events: the first subscriber starts stepping the model at ?rate= steps per second;
+        # every event has the changes since the last event sent to that client, so slow clients get
+        # one coalesced event instead of a backlog. Reconnecting clients resume from Last-Event-ID.
+        session = currentSession()
+        if session.look_ahead is not None:
+            # Both would step the same model
+            abort(make_response(jsonify({'error': 'The session was initiated with lookAhead'}), 409))
+        rate = queryNumber('rate', float)
+        if rate is not None and not rate > 0:
+            badRequest('rate must be a positive number of steps per second')
+        # Parsed before the response starts, which couldn't report the error anymore
+        since = request.args.get('since', request.headers.get('Last-Event-ID'))
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            badRequest('since and Last-Event-ID must be the step of an event')
+        with session.lock:
+            if session.stream is None or session.stream.stopped:
+                session.stream = StepStream(lambda: streamAdvance(session), lambda since: changesPayload(session, since),
+                                            session.model.cant_steps, rate if rate is not None else 10.0, session.lock)
+                session.stream.start()
+            elif rate is not None:
+                session.stream.rate = rate
+            stream = session.stream
+
+        def events():
+            for payload in stream.subscribe(since):
+                if payload is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"id: {payload['step']}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+        return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+instrument_app(app, metrics, "warehouse")
 
 if __name__=='__main__':
-    app.run(host="localhost", port=8585, debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = "Flask server of the warehouse simulation.")
+    parser.add_argument("--host", default = "localhost")
+    parser.add_argument("--port", type = int, default = 8585)
+    parser.add_argument("--production", action = "store_true",
+                        help = "serve with waitress (pip install waitress) instead of the Flask development server")
+    parser.add_argument("--threads", type = int, default = 16,
+                        help = "request threads of waitress; every open /stream holds one")
+    args = parser.parse_args()
+    if args.production:
+        try:
+            from waitress import serve
+        except ImportError:
+            parser.error("--production needs waitress: pip install waitress")
+        serve(app, host=args.host, port=args.port, threads=args.threads)
+    else:
+        app.run(host=args.host, port=args.port, debug=True, threaded=True)
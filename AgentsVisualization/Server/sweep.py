@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Headless parameter sweep for the warehouse model.
+
+Runs every combination of (N, max_shelves, N_boxes, width, height, max_moves,
+seed) without the server, spread over a process pool, until all the boxes are
+dropped or max_moves is reached. Tasks are sent to the workers in chunks and
+each worker keeps its imports and a small in-memory event journal between
+runs. The results are written as a columnar .npz file, one array per column.
+
+Usage:
+    python sweep.py results.npz --N 10 50 --boxes 20 --size 30 60 --seeds 100
+    python sweep.py results.npz --engine vectorized --workers 8
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import argparse
+import itertools
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+from RobotAgents import RobotModel
+from EventJournal import EventJournal
+
+PARAMETERS = ["N", "max_shelves", "N_boxes", "width", "height", "max_moves", "seed"]
+COLUMNS = PARAMETERS + ["cant_steps", "total_moves", "boxes_dropped", "wall_time"]
+
+# Journal reused by every run of a worker process
+worker_journal = None
+
+def init_worker():
+    global worker_journal
+    worker_journal = EventJournal(capacity = 4096)
+
+def run_simulation(task):
+    '''
+    Runs one model to completion and returns its parameters followed by the results.
+    Args:
+        task: Tuple with the PARAMETERS values plus the engine and planner to use
+    '''
+    N, max_shelves, N_boxes, width, height, max_moves, seed, engine, planner = task
+    journal = worker_journal if worker_journal is not None else EventJournal(capacity = 4096)
+    journal.clear()
+    start = time.perf_counter()
+    model = RobotModel(N, max_shelves, N_boxes, width, height, max_moves, engine = engine, seed = seed,
+                       journal = journal, planner = planner)
+    while model.boxes_dropped < model.num_boxes and model.cant_steps < model.max_moves:
+        model.step()
+    wall_time = time.perf_counter() - start
+    return (N, max_shelves, N_boxes, width, height, max_moves, seed,
+            model.cant_steps, model.total_moves, model.boxes_dropped, wall_time)
+
+def make_tasks(N, max_shelves, N_boxes, sizes, max_moves, seeds, engine = "agents", planner = None):
+    '''Cartesian product of the parameter lists; sizes are (width, height) pairs.'''
+    return [(n, shelves, boxes, width, height, moves, seed, engine, planner)
+            for n, shelves, boxes, (width, height), moves, seed
+            in itertools.product(N, max_shelves, N_boxes, sizes, max_moves, seeds)]
+
+def run_sweep(tasks, workers = None, chunksize = None):
+    '''Runs the tasks over a process pool and returns a dictionary of column arrays.'''
+    workers = workers or os.cpu_count()
+    if chunksize is None:
+        # A few chunks per worker: small enough to balance, big enough to keep the dispatch cheap
+        chunksize = max(1, len(tasks) // (workers * 4))
+    if workers == 1:
+        init_worker()
+        rows = [run_simulation(task) for task in tasks]
+    else:
+        with Pool(workers, initializer = init_worker) as pool:
+            rows = list(pool.imap_unordered(run_simulation, tasks, chunksize = chunksize))
+    columns = {name: np.array([row[i] for row in rows]) for i, name in enumerate(COLUMNS)}
+    # Same order no matter which worker finished first
+    order = np.lexsort([columns[name] for name in reversed(PARAMETERS)]) if rows else []
+    return {name: column[order] for name, column in columns.items()}
+
+def save_results(path, columns):
+    np.savez(path, **columns)
+
+def load_results(path):
+    with np.load(path) as results:
+        return {name: results[name] for name in results.files}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Run a headless parameter sweep of the warehouse model.")
+    parser.add_argument("output", help = "columnar .npz results file")
+    parser.add_argument("--N", type = int, nargs = "+", default = [10])
+    parser.add_argument("--shelves", type = int, nargs = "+", default = [5])
+    parser.add_argument("--boxes", type = int, nargs = "+", default = [10])
+    parser.add_argument("--size", type = int, nargs = "+", default = [28], help = "square warehouse sides")
+    parser.add_argument("--max-moves", type = int, nargs = "+", default = [1000])
+    parser.add_argument("--seeds", type = int, default = 10, help = "seeds 0 .. seeds - 1 for every combination")
+    parser.add_argument("--engine", choices = ["agents", "vectorized"], default = "agents")
+    parser.add_argument("--planner", choices = ["cooperative"], default = None)
+    parser.add_argument("--workers", type = int, default = None)
+    parser.add_argument("--chunksize", type = int, default = None)
+    args = parser.parse_args()
+
+    tasks = make_tasks(args.N, args.shelves, args.boxes, [(size, size) for size in args.size], args.max_moves,
+                       range(args.seeds), args.engine, args.planner)
+    start = time.perf_counter()
+    columns = run_sweep(tasks, args.workers, args.chunksize)
+    save_results(args.output, columns)
+    finished = (columns["boxes_dropped"] == columns["N_boxes"]).sum() if len(tasks) else 0
+    print(f"{len(tasks)} runs ({finished} finished) in {time.perf_counter() - start:.1f} s -> {args.output}")
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+The server modules import each other by their bare names, as when server.py
+is run from its directory, so the tests put that directory on sys.path.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import os
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental updates of the DistanceField against a field built from scratch.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import random
+
+import numpy as np
+import pytest
+
+from RobotAgents import RobotModel, DistanceField, EMPTY
+
+@pytest.mark.parametrize("seed", range(5))
+def test_opened_cells_match_rebuild(seed):
+    '''Taking the boxes off the floor one by one in a random order keeps every field equal to a rebuilt one.'''
+    model = RobotModel(5, 120, 250, 24, 24, 100, seed = seed, N_drop_zones = 3)
+    rng = random.Random(seed)
+    # A field with several sources, besides the ones to the drop zones
+    empties = list(zip(*np.nonzero(model.grid.cells == EMPTY)))
+    model.distance_fields.append(DistanceField(model.grid, [(int(x), int(y)) for x, y in rng.sample(empties, 4)]))
+    boxes = list(model.grid.registries["box"].values())
+    rng.shuffle(boxes)
+    for box in boxes:
+        pos = model.remove_box(box)
+        for field in model.distance_fields:
+            expected = field.distances.copy()
+            field.rebuild()
+            assert np.array_equal(field.distances, expected), pos
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Packed binary frames, whose layout the C# client reads field by field.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import struct
+
+import pytest
+
+from RobotFrame import encode_frame, decode_frame, HEADER, ROBOT, BOX, MAGIC, RUNNING, FULL, HAS_BOX
+
+def test_record_sizes():
+    assert (HEADER.itemsize, ROBOT.itemsize, BOX.itemsize) == (21, 9, 8)
+
+def test_round_trip():
+    frame = encode_frame(70000, 12, True, [1000, 1001, 1002], [1, 27, 300], [2, 14, 299], [False, True, True],
+                         [3, 40], [5, 6], [7, 8], full = True)
+    assert len(frame) == 21 + 3 * 9 + 2 * 8
+    header, robots, boxes = decode_frame(frame)
+    assert (header["magic"], header["step"], header["dropped_boxes"]) == (MAGIC, 70000, 12)
+    assert header["flags"] == RUNNING | FULL
+    assert robots["id"].tolist() == [1000, 1001, 1002]
+    assert robots["x"].tolist() == [1, 27, 300] and robots["z"].tolist() == [2, 14, 299]
+    assert robots["flags"].tolist() == [0, HAS_BOX, HAS_BOX]
+    assert boxes["id"].tolist() == [3, 40] and boxes["x"].tolist() == [5, 6] and boxes["z"].tolist() == [7, 8]
+
+def test_little_endian_layout():
+    '''The bytes a BinaryReader sees, field by field.'''
+    frame = encode_frame(5, 2, False, [1001], [3], [4], [True], [9], [10], [11])
+    assert frame[:21] == b"WHF1" + struct.pack("<IIBII", 5, 2, 0, 1, 1)
+    assert frame[21:30] == struct.pack("<ihhB", 1001, 3, 4, HAS_BOX)
+    assert frame[30:] == struct.pack("<ihh", 9, 10, 11)
+
+def test_empty_frame_and_bad_magic():
+    header, robots, boxes = decode_frame(encode_frame(0, 0, False, [], [], [], []))
+    assert header["flags"] == 0 and len(robots) == 0 and len(boxes) == 0
+    with pytest.raises(ValueError):
+        decode_frame(b"XXXX" + bytes(17))
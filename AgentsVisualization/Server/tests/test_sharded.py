@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Invariants of the ShardedEngine across its tiles.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import pytest
+
+from RobotAgents import RobotModel, ROBOT, BOX
+
+def sharded_model(tiles, seed = 4, max_moves = 60):
+    return RobotModel(60, 30, 80, 30, 30, max_moves, engine = "sharded", seed = seed, tiles = tiles)
+
+def final_state(model):
+    ids, x, y, has_box = model.robot_arrays()
+    return (model.cant_steps, model.boxes_dropped, model.total_moves,
+            x.tolist(), y.tolist(), has_box.tolist(), sorted(model.grid.registries["box"]))
+
+def test_one_tile_matches_simultaneous():
+    model = RobotModel(60, 30, 80, 30, 30, 60, engine = "simultaneous", seed = 4)
+    model.advance(until_done = True)
+    expected = final_state(model)
+    model = sharded_model((1, 1))
+    try:
+        model.advance(until_done = True)
+        assert final_state(model) == expected
+    finally:
+        model.close()
+
+@pytest.mark.parametrize("tiles", [(2, 2), (3, 2)])
+def test_tiles_keep_robots_and_boxes(tiles):
+    model = sharded_model(tiles)
+    try:
+        while model.step():
+            ids, x, y, has_box = model.robot_arrays()
+            cells = model.grid.cells
+            # One robot per cell, and the occupancy array agrees with the robot arrays
+            assert len(set(zip(x.tolist(), y.tolist()))) == len(ids)
+            assert (cells[x, y] == ROBOT).all() and (cells == ROBOT).sum() == len(ids)
+            # Every box is on the floor, carried or dropped
+            floor = (cells == BOX).sum()
+            assert floor == len(model.grid.registries["box"])
+            assert floor + has_box.sum() + model.boxes_dropped == model.num_boxes
+    finally:
+        model.close()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Conflict resolution of the SimultaneousScheduler.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import random
+
+import pytest
+
+from RobotAgents import RobotModel
+from SimultaneousScheduler import Snapshot, propose, resolve, STAY, PICK_UP, MOVE_TO
+
+def proposals_of(model):
+    '''States and proposals of the robots of a simultaneous model, as its scheduler computes them.'''
+    schedule = model.schedule
+    _, states = schedule.robot_states()
+    snapshot = Snapshot.of_model(model, schedule.box_field, schedule.seed)
+    return states, [propose(state, snapshot) for state in states]
+
+def check_resolution(states, proposals, granted, moves):
+    '''Moving the robots one by one in the order given, each one enters a cell nobody is in.'''
+    assert sorted(moves) == [index for index, (action, _) in enumerate(granted) if action == MOVE_TO]
+    occupied = {state[1:3] for state in states}
+    for index in moves:
+        cell = granted[index][1]
+        assert cell in proposals[index][1]
+        # Also catches swaps and cycles, where some robot enters the cell of one that hasn't left yet
+        assert cell not in occupied
+        occupied.remove(states[index][1:3])
+        occupied.add(cell)
+    boxes = [cell for action, cell in granted if action == PICK_UP]
+    assert len(boxes) == len(set(boxes))
+
+@pytest.mark.parametrize("seed", range(3))
+def test_no_collisions_and_order_independent(seed):
+    # Crowded enough for plenty of conflicts
+    model = RobotModel(150, 60, 150, 30, 30, 30, engine = "simultaneous", seed = seed)
+    rng = random.Random(seed)
+    while model.running:
+        states, proposals = proposals_of(model)
+        granted, moves = resolve(states, proposals)
+        check_resolution(states, proposals, granted, moves)
+
+        order = list(range(len(states)))
+        rng.shuffle(order)
+        shuffled_granted, shuffled_moves = resolve([states[i] for i in order], [proposals[i] for i in order])
+        assert [shuffled_granted[order.index(i)] for i in range(len(states))] == granted
+        assert sorted(order[i] for i in shuffled_moves) == sorted(moves)
+        model.step()
+
+def test_swaps_and_cycles_wait():
+    robots = [(1, 1, 1, False, -1), (2, 2, 1, False, -1)]
+    granted, moves = resolve(robots, [(MOVE_TO, ((2, 1),)), (MOVE_TO, ((1, 1),))])
+    assert granted == [(STAY, None), (STAY, None)] and moves == []
+
+    robots = [(1, 1, 1, False, -1), (2, 2, 1, False, -1), (3, 2, 2, False, -1)]
+    proposals = [(MOVE_TO, ((2, 1), (1, 2))), (MOVE_TO, ((2, 2),)), (MOVE_TO, ((1, 1),))]
+    granted, moves = resolve(robots, proposals)
+    check_resolution(robots, proposals, granted, moves)
+    # Every robot of the cycle falls back to its next cell; only robot 1 has one
+    assert granted == [(MOVE_TO, (1, 2)), (STAY, None), (STAY, None)]
+
+def test_followers_move_after_the_robot_ahead():
+    robots = [(1, 1, 1, False, -1), (2, 2, 1, False, -1)]
+    proposals = [(MOVE_TO, ((2, 1),)), (MOVE_TO, ((3, 1),))]
+    granted, moves = resolve(robots, proposals)
+    assert granted == [(MOVE_TO, (2, 1)), (MOVE_TO, (3, 1))]
+    assert moves == [1, 0]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots: a restored model continues step for step like the original.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import numpy as np
+import pytest
+
+from RobotAgents import RobotModel
+
+def state(model):
+    '''Counters, robot arrays and boxes on the floor of a model.'''
+    ids, x, y, has_box = model.robot_arrays()
+    boxes = sorted((unique_id, box.pos) for unique_id, box in model.grid.registries["box"].items())
+    return (model.cant_steps, model.boxes_dropped, model.total_moves, model.running,
+            ids.tolist(), x.tolist(), y.tolist(), has_box.tolist(), boxes)
+
+@pytest.mark.parametrize("engine", ["agents", "vectorized", "simultaneous", "sharded"])
+def test_restored_model_continues_like_the_original(engine, tmp_path):
+    path = str(tmp_path / "model.bin")
+    original = RobotModel(40, 60, 60, 35, 35, 3000, engine = engine, seed = 3, N_drop_zones = 2)
+    restored = None
+    try:
+        original.advance(25)
+        original.save(path)
+        restored = RobotModel.load(path)
+        assert state(restored) == state(original)
+        assert np.array_equal(restored.grid.cells, original.grid.cells)
+        for step in range(60):
+            original.step()
+            restored.step()
+            assert state(restored) == state(original), step
+    finally:
+        original.close()
+        if restored is not None:
+            restored.close()
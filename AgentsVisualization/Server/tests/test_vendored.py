@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Copies of the server modules vendored into apps that are deployed on their own.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import ast
+import os
+
+from conftest import SERVER_DIR
+
+REPO_DIR = os.path.dirname(os.path.dirname(SERVER_DIR))
+
+def after_docstring(path):
+    '''Source of the module after its docstring, which says where the copy comes from.'''
+    with open(path, encoding = "utf-8") as file:
+        source = file.read()
+    docstring = ast.parse(source).body[0]
+    return source.splitlines()[docstring.end_lineno:]
+
+def test_boids_metrics_matches_server():
+    assert after_docstring(os.path.join(REPO_DIR, "IBMCloud", "boids", "metrics.py")) == \
+        after_docstring(os.path.join(SERVER_DIR, "Metrics.py"))
+
+def test_trimmed_profilers_match():
+    '''The boids app and the mesa examples run the same trimmed profiler; only their docstrings differ.'''
+    copies = [after_docstring(os.path.join(REPO_DIR, *path)) for path in
+              (("IBMCloud", "boids", "profiler.py"), ("mesaExamples", "forestFire", "profiler.py"),
+               ("mesaExamples", "randomAgents", "profiler.py"))]
+    assert copies[1] == copies[0] and copies[2] == copies[0]
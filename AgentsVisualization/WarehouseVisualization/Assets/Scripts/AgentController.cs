@@ -4,6 +4,7 @@
 
 using System.Collections;
 using System.Collections.Generic;
+using System.IO;
 using UnityEngine;
 using UnityEngine.UI;
 using UnityEngine.Networking;
@@ -55,6 +56,21 @@ public class ModelData
     public int droppedBoxes;
 }
 [System.Serializable]
+public class InitData
+{
+    public string message;
+    public string session;
+}
+[System.Serializable]
+public class TickData
+{
+    public int currentStep;
+    public int droppedBoxes;
+    public bool full;
+    public List<AgentData> robots_attributes;
+    public List<ObstacleData> obstacles_attributes;
+}
+[System.Serializable]
 public class DroppedBoxes
 {
     public int droppedBoxes;
@@ -68,6 +84,13 @@ public class AgentController : MonoBehaviour
     string getObstaclesEndpoint = "/getObstacles";
     string sendConfigEndpoint = "/init";
     string updateEndpoint = "/update";
+    string tickEndpoint = "/tick";
+    string getLayoutEndpoint = "/getLayout";
+    // Packed binary robot state, see RobotFrame.py on the server
+    string frameMimetype = "application/x-warehouse-frame";
+    string layoutEtag = "";
+    // Session of this client's model, returned by /init
+    string session = "";
     AgentsData robotsData;
     ObstaclesData obstacleData;
     GameObject[] agents;
@@ -75,10 +98,17 @@ public class AgentController : MonoBehaviour
     List<Vector3> newPositions;
     // List<int> unique_ids;
     bool hold = false;
+    // Markers of the drop zones after the first one, replaced on every reload
+    List<GameObject> extraDropZones = new List<GameObject>();
 
     public GameObject robotPrefab, boxPrefab, shelfPrefab, floor, wallPrefab, doorPrefab, drop_zone, reloadButton;
     public Text currentStep;
-    public int NAgents, NBoxes, width, height, maxShelves, maxSteps;
+    public int NAgents, NBoxes, width, height, maxShelves, maxSteps, NDropZones = 1;
+    // Steps the server computes ahead of the client between ticks, 0 to step on every request
+    public int lookAhead = 0;
+    // Step engine of the server model; "sharded" steps tileColumns x tileRows tiles of the grid in parallel
+    public string engine = "agents";
+    public int tileColumns = 2, tileRows = 2;
     public float timeToUpdate = 5.0f, timer, dt;
 
     void Start()
@@ -131,34 +161,41 @@ public class AgentController : MonoBehaviour
  
     IEnumerator UpdateSimulation()
     {
-        UnityWebRequest www = UnityWebRequest.Get(serverUrl + updateEndpoint);
+        // Steps the model and gets the robots and the picked up boxes in a single request
+        UnityWebRequest www = UnityWebRequest.Get(SessionUrl(tickEndpoint));
+        www.SetRequestHeader("Accept", frameMimetype);
         yield return www.SendWebRequest();
  
         if (www.result != UnityWebRequest.Result.Success)
             Debug.Log(www.error);
         else 
         {
-            ModelData model = JsonUtility.FromJson<ModelData>(www.downloadHandler.text);
-            currentStep.text = "Boxes found: " + model.droppedBoxes + "/" + NBoxes + "\n" +
-                               "Step " + model.currentStep;
-            if(model.currentStep >= maxSteps || model.droppedBoxes >= NBoxes)
+            TickData tick = ReadFrame(www.downloadHandler.data);
+            currentStep.text = "Boxes found: " + tick.droppedBoxes + "/" + NBoxes + "\n" +
+                               "Step " + tick.currentStep;
+            UpdateRobots(tick.robots_attributes);
+            UpdateBoxes(tick);
+            if(tick.currentStep >= maxSteps || tick.droppedBoxes >= NBoxes)
             {
                 currentStep.text += "\nSimulation complete.";
                 reloadButton.SetActive(true);
             }
-            else
-            {
-                StartCoroutine(UpdateRobotsData());
-                StartCoroutine(UpdateObstaclesData());
-            }
         }
     }
 
+    string SessionUrl(string endpoint)
+    {
+        return serverUrl + endpoint + "?session=" + UnityWebRequest.EscapeURL(session);
+    }
+
     public void InitialConfiguration()
     {
         GameObject[] robots = GameObject.FindGameObjectsWithTag("Robot");
         foreach(GameObject robot in robots)
             GameObject.Destroy(robot);
+        foreach(GameObject marker in extraDropZones)
+            GameObject.Destroy(marker);
+        extraDropZones.Clear();
         StartCoroutine(SendConfiguration());
     }
     IEnumerator SendConfiguration()
@@ -171,6 +208,13 @@ public class AgentController : MonoBehaviour
         form.AddField("height", height.ToString());
         form.AddField("maxShelves", maxShelves.ToString());
         form.AddField("maxSteps", maxSteps.ToString());
+        form.AddField("NDropZones", NDropZones.ToString());
+        form.AddField("lookAhead", lookAhead.ToString());
+        form.AddField("engine", engine);
+        form.AddField("tiles", tileColumns.ToString() + "x" + tileRows.ToString());
+        // Start our own session over instead of opening a new one on reload
+        if (session != "")
+            form.AddField("session", session);
 
         UnityWebRequest www = UnityWebRequest.Post(serverUrl + sendConfigEndpoint, form);
         www.SetRequestHeader("Content-Type", "application/x-www-form-urlencoded");
@@ -184,11 +228,13 @@ public class AgentController : MonoBehaviour
         else
         {
             //Debug.Log("Configuration upload complete!");
+            session = JsonUtility.FromJson<InitData>(www.downloadHandler.text).session;
             StartCoroutine(GetRobotsData());
+            StartCoroutine(GetLayoutData());
             StartCoroutine(GetObstacleData());
         }
 
-        www = UnityWebRequest.Get(serverUrl + sendConfigEndpoint);
+        www = UnityWebRequest.Get(SessionUrl(sendConfigEndpoint));
         yield return www.SendWebRequest();
 
         if (www.result != UnityWebRequest.Result.Success)
@@ -197,17 +243,21 @@ public class AgentController : MonoBehaviour
         }
         else
         {
-            // Assign position to the drop zone
+            // Assign position to the drop zones, one copy of the marker for each extra zone
             Drop_zones drop_zones = JsonUtility.FromJson<Drop_zones>(www.downloadHandler.text);
             drop_zone.transform.position = new Vector3(drop_zones.drop_zone_pos[0].x,
                                                        drop_zone.transform.position.y, 
                                                        drop_zones.drop_zone_pos[0].y);
+            for(int i = 1; i < drop_zones.drop_zone_pos.Count; i++)
+                extraDropZones.Add(Instantiate(drop_zone, new Vector3(drop_zones.drop_zone_pos[i].x,
+                                                                      drop_zone.transform.position.y,
+                                                                      drop_zones.drop_zone_pos[i].y), drop_zone.transform.rotation));
         }
     }
 
     IEnumerator GetRobotsData() 
     {
-        UnityWebRequest www = UnityWebRequest.Get(serverUrl + getAgentsEndpoint);
+        UnityWebRequest www = UnityWebRequest.Get(SessionUrl(getAgentsEndpoint));
         yield return www.SendWebRequest();
  
         if (www.result != UnityWebRequest.Result.Success)
@@ -229,47 +279,80 @@ public class AgentController : MonoBehaviour
         }
     }
 
-    IEnumerator UpdateRobotsData() 
+    TickData ReadFrame(byte[] data)
     {
-        UnityWebRequest www = UnityWebRequest.Get(serverUrl + getAgentsEndpoint);
-        yield return www.SendWebRequest();
- 
-        if (www.result != UnityWebRequest.Result.Success)
-            Debug.Log(www.error);
-        else 
+        // BinaryReader is little-endian, like the frame
+        TickData tick = new TickData();
+        tick.robots_attributes = new List<AgentData>();
+        tick.obstacles_attributes = new List<ObstacleData>();
+        using (BinaryReader reader = new BinaryReader(new MemoryStream(data)))
         {
-            robotsData = JsonUtility.FromJson<AgentsData>(www.downloadHandler.text);
-            // Store the old positions for each agent
-            oldPositions = new List<Vector3>(newPositions);
-            newPositions.Clear();
-
-            for(int i = 0; i < robotsData.robots_attributes.Count; i++) {
-                AgentData agentData = robotsData.robots_attributes[i];
-                newPositions.Add(new Vector3(agentData.x, agentData.y, agentData.z));
-                agents[i].transform.GetChild(1).gameObject.SetActive(agentData.has_box);
+            reader.ReadBytes(4); // "WHF1"
+            tick.currentStep = (int)reader.ReadUInt32();
+            tick.droppedBoxes = (int)reader.ReadUInt32();
+            byte flags = reader.ReadByte();
+            tick.full = (flags & 2) != 0;
+            uint robotCount = reader.ReadUInt32();
+            uint boxCount = reader.ReadUInt32();
+            for (uint i = 0; i < robotCount; i++)
+            {
+                AgentData agent = new AgentData();
+                agent.unique_id = reader.ReadInt32();
+                agent.x = reader.ReadInt16();
+                agent.y = 1;
+                agent.z = reader.ReadInt16();
+                agent.has_box = (reader.ReadByte() & 1) != 0;
+                tick.robots_attributes.Add(agent);
             }
+            for (uint i = 0; i < boxCount; i++)
+            {
+                ObstacleData box = new ObstacleData();
+                box.unique_id = reader.ReadInt32();
+                box.x = reader.ReadInt16();
+                box.y = 1;
+                box.z = reader.ReadInt16();
+                box.tag = "box";
+                box.picked_up = !tick.full;
+                tick.obstacles_attributes.Add(box);
+            }
+        }
+        return tick;
+    }
 
-            hold = false;
+    void UpdateRobots(List<AgentData> robots_attributes)
+    {
+        // Store the old positions for each agent
+        oldPositions = new List<Vector3>(newPositions);
+        newPositions.Clear();
+
+        for(int i = 0; i < robots_attributes.Count; i++) {
+            AgentData agentData = robots_attributes[i];
+            newPositions.Add(new Vector3(agentData.x, agentData.y, agentData.z));
+            agents[i].transform.GetChild(1).gameObject.SetActive(agentData.has_box);
         }
+
+        hold = false;
     }
 
-    IEnumerator GetObstacleData() 
+    IEnumerator GetLayoutData()
     {
-        UnityWebRequest www = UnityWebRequest.Get(serverUrl + getObstaclesEndpoint);
+        // Borders and shelves; the server answers 304 if they are the ones we already have
+        UnityWebRequest www = UnityWebRequest.Get(SessionUrl(getLayoutEndpoint));
+        if (layoutEtag != "")
+            www.SetRequestHeader("If-None-Match", layoutEtag);
         yield return www.SendWebRequest();
- 
+
+        if (www.responseCode == 304)
+            yield break;
         if (www.result != UnityWebRequest.Result.Success)
             Debug.Log(www.error);
-        else 
+        else
         {
-            obstacleData = JsonUtility.FromJson<ObstaclesData>(www.downloadHandler.text);
-            // Recieve tags from json and check for instantiation
-            foreach(ObstacleData obstacle in obstacleData.obstacles_attributes)
+            layoutEtag = www.GetResponseHeader("ETag");
+            ObstaclesData layoutData = JsonUtility.FromJson<ObstaclesData>(www.downloadHandler.text);
+            foreach(ObstacleData obstacle in layoutData.obstacles_attributes)
             {
-                if (obstacle.tag == "box") {
-                    Instantiate(boxPrefab, new Vector3(obstacle.x, obstacle.y, obstacle.z), Quaternion.identity);
-                }
-                else if (obstacle.tag == "shelf") {
+                if (obstacle.tag == "shelf") {
                     Instantiate(shelfPrefab, new Vector3(obstacle.x, obstacle.y, obstacle.z), Quaternion.identity);
                 }
                 else if (obstacle.tag == "border") {
@@ -279,9 +362,9 @@ public class AgentController : MonoBehaviour
         }
     }
 
-    IEnumerator UpdateObstaclesData()
+    IEnumerator GetObstacleData() 
     {
-        UnityWebRequest www = UnityWebRequest.Get(serverUrl + getObstaclesEndpoint);
+        UnityWebRequest www = UnityWebRequest.Get(SessionUrl(getObstaclesEndpoint));
         yield return www.SendWebRequest();
  
         if (www.result != UnityWebRequest.Result.Success)
@@ -289,24 +372,34 @@ public class AgentController : MonoBehaviour
         else 
         {
             obstacleData = JsonUtility.FromJson<ObstaclesData>(www.downloadHandler.text);
-            // Recieve tags from json and check for instantiation
-            bool boxGOSurvives;
+            // Only the boxes come here, the borders and shelves come with the layout
+            foreach(ObstacleData obstacle in obstacleData.obstacles_attributes)
+            {
+                if (obstacle.tag == "box") {
+                    Instantiate(boxPrefab, new Vector3(obstacle.x, obstacle.y, obstacle.z), Quaternion.identity);
+                }
+            }
+        }
+    }
 
-            foreach(GameObject boxGameObject in GameObject.FindGameObjectsWithTag("Box")) {
-                boxGOSurvives = false;
-                foreach(ObstacleData obstacle in obstacleData.obstacles_attributes)
+    void UpdateBoxes(TickData tick)
+    {
+        // The tick lists the boxes picked up since the last one, or every box
+        // still on the floor when the server fast-forwarded past its change log
+        foreach(GameObject boxGameObject in GameObject.FindGameObjectsWithTag("Box")) {
+            bool listed = false;
+            foreach(ObstacleData obstacle in tick.obstacles_attributes)
+            {
+                if (obstacle.tag == "box" && 
+                    boxGameObject.transform.position.x == obstacle.x && 
+                    boxGameObject.transform.position.z == obstacle.z) 
                 {
-                    if (obstacle.tag == "box" && 
-                        boxGameObject.transform.position.x == obstacle.x && 
-                        boxGameObject.transform.position.z == obstacle.z) 
-                    {
-                        boxGOSurvives = true;
-                    }
-                }  
-                if (!boxGOSurvives) {
-                    Destroy(boxGameObject);
-                }     
-            }
+                    listed = true;
+                }
+            }  
+            if (listed != tick.full) {
+                Destroy(boxGameObject);
+            }     
         }
     }
 }
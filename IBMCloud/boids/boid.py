@@ -1,4 +1,5 @@
 from vector import Vector
+from profiler import profiler
 import numpy as np
 
 class Boid():
@@ -30,9 +31,14 @@ class Boid():
 
 
     def apply_behaviour(self, boids):
+        # The three rule loops are the phases of the profiler (a no-op unless it is enabled)
+        phase = profiler.clock()
         alignment = self.align(boids)
+        phase = profiler.mark("Boid.align", phase)
         cohesion = self.cohesion(boids)
+        phase = profiler.mark("Boid.cohesion", phase)
         separation = self.separation(boids)
+        profiler.mark("Boid.separation", phase)
 
         self.acceleration += alignment
         self.acceleration += cohesion
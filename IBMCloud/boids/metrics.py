@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus-style metrics of the simulation servers.
+
+Every series is created once, when the server starts, and a request only
+adds to numbers that already exist: a histogram finds its fixed bucket with
+a bisection and increments it. Gauges that describe the live state (models,
+sessions, agents) are functions evaluated only when /metrics is scraped.
+exposition() writes the Prometheus text exposition format, version 0.0.4.
+
+Vendored copy of AgentsVisualization/Server/Metrics.py: Cloud Foundry only
+uploads this directory, so the boids app can't import it from there. Change
+that file and copy everything after this docstring here;
+AgentsVisualization/Server/tests/test_vendored.py fails while they differ.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds, in seconds, for request and step durations
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds, in bytes, for response payloads
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+class Gauge:
+    """
+    Value read from function every time the metrics are scraped.
+    Attributes:
+        function: Function without arguments that returns the current value
+    """
+    kind = "gauge"
+
+    def __init__(self, function):
+        self.function = function
+
+    def samples(self, name, labels):
+        yield name, labels, self.function()
+
+class Histogram:
+    """
+    Counts of observations in fixed buckets, plus their sum.
+    Attributes:
+        buckets: Sorted upper bounds of the buckets; larger values only count in +Inf
+        counts: Observations in each bucket (not cumulative), the last one for +Inf
+        sum: Sum of every observation
+    """
+    kind = "histogram"
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            yield name + "_bucket", labels + (("le", "+Inf" if bound == float("inf") else repr(float(bound))),), cumulative
+        yield name + "_sum", labels, total
+        yield name + "_count", labels, cumulative
+
+class MetricsRegistry:
+    """
+    Every metric of a server, grouped in families by name.
+    Attributes:
+        families: Dictionary from name to (help, kind, list of (labels, metric)), in registration order
+    """
+    def __init__(self):
+        self.families = {}
+
+    def register(self, name, help, metric, labels = None):
+        '''Adds a series to the family name; labels is a dictionary from label name to value.'''
+        family = self.families.setdefault(name, (help, metric.kind, []))
+        if family[1] != metric.kind:
+            raise ValueError(f"{name} is already a {family[1]}")
+        family[2].append((tuple((labels or {}).items()), metric))
+        return metric
+
+    def gauge(self, name, help, function, labels = None):
+        return self.register(name, help, Gauge(function), labels)
+
+    def histogram(self, name, help, buckets = DURATION_BUCKETS, labels = None):
+        return self.register(name, help, Histogram(buckets), labels)
+
+    def exposition(self):
+        '''Every series in the Prometheus text format.'''
+        lines = []
+        for name, (help, kind, series) in self.families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series:
+                for sample, sample_labels, value in metric.samples(name, labels):
+                    lines.append(f"{sample}{format_labels(sample_labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(str(value))}"' for key, value in labels) + "}"
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+def instrument_app(app, registry, prefix):
+    '''
+    Adds the request latency and payload size histograms of every route of the Flask app,
+    and the /metrics route that serves the registry. Call it after every route is defined.
+    '''
+    from flask import Response, g, request
+
+    def route_series(route):
+        labels = {"route": route}
+        return (registry.histogram(f"{prefix}_request_duration_seconds", "Time to answer a request, by route", labels = labels),
+                registry.histogram(f"{prefix}_response_bytes", "Size of the response body, by route", SIZE_BUCKETS, labels))
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.exposition(), content_type = CONTENT_TYPE)
+
+    series = {rule.rule: route_series(rule.rule) for rule in app.url_map.iter_rules() if rule.endpoint != "static"}
+    # Requests that match no route (404s) share one series
+    unmatched = route_series("unmatched")
+
+    @app.before_request
+    def start_timer():
+        g.request_start = perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        rule = request.url_rule
+        duration, size = series.get(rule.rule, unmatched) if rule is not None else unmatched
+        duration.observe(perf_counter() - g.request_start)
+        # Streamed responses (SSE) have no length
+        if response.content_length is not None:
+            size.observe(response.content_length)
+        return response
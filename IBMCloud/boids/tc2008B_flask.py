@@ -4,15 +4,20 @@
 
 from flask import Flask, request, jsonify
 from boid import Boid
-import logging, json, os, numpy as np
+from metrics import MetricsRegistry, instrument_app
+from profiler import profiler
+import logging, json, os, time, numpy as np
 
 def updatePositions(flock):
     positions = []
     for boid in flock:
         boid.apply_behaviour(flock)
+        phase = profiler.clock()
         boid.update()
         pos = boid.edges()
+        profiler.mark("Boid.update", phase)
         positions.append(pos)
+    profiler.step_done()
     return positions
 
 def positionsToJSON(ps):
@@ -39,14 +44,23 @@ port = int(os.getenv('PORT', 8000))
 
 app = Flask("Boids example", static_url_path='')
 
+# Served at /metrics; the request series of every route are added by instrument_app below
+metrics = MetricsRegistry()
+update_seconds = metrics.histogram("boids_update_duration_seconds", "Time to run updatePositions")
+metrics.gauge("boids_agents", "Boids in the flock", lambda: len(flock))
+
 @app.route('/', methods=['POST', 'GET'])
 def boidsPosition():
     if request.method == 'GET':
+        start = time.perf_counter()
         positions = updatePositions(flock)
+        update_seconds.observe(time.perf_counter() - start)
         # resp = "{\"data\":" + positionsToJSON(positions) + "}"
         return positionsToJSON(positions)
     elif request.method == 'POST':
         return "Post request from Boids example\n"
 
+instrument_app(app, metrics, "boids")
+
 if __name__=='__main__':
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
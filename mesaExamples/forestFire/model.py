@@ -4,6 +4,7 @@ from mesa.space import Grid
 from mesa.time import RandomActivation
 
 from agent import TreeCell
+from profiler import profiler
 
 class ForestFire(Model):
     """
@@ -47,9 +48,13 @@ class ForestFire(Model):
         """
         Advance the model by one step.
         """
+        phase = profiler.clock()
         self.schedule.step()
+        phase = profiler.mark("schedule.step", phase)
         # collect data
         self.datacollector.collect(self)
+        profiler.mark("DataCollector.collect", phase)
+        profiler.step_done()
 
         # Halt if no more fire
         if self.count_type(self, "On Fire") == 0:
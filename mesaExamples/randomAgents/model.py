@@ -3,6 +3,7 @@ from mesa.time import RandomActivation
 from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
 from agent import RandomAgent, ObstacleAgent
+from profiler import profiler
 
 class RandomModel(Model):
     """ 
@@ -43,5 +44,9 @@ class RandomModel(Model):
 
     def step(self):
         '''Advance the model by one step.'''
+        phase = profiler.clock()
         self.schedule.step()
-        self.datacollector.collect(self)
\ No newline at end of file
+        phase = profiler.mark("schedule.step", phase)
+        self.datacollector.collect(self)
+        profiler.mark("DataCollector.collect", phase)
+        profiler.step_done()
\ No newline at end of file
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Phase-level profiler of the random agents steps.
+
+The step takes the time with profiler.clock() and closes each phase with
+profiler.mark(name, start), which returns the time to start the next phase
+from:
+
+    phase = profiler.clock()
+    self.schedule.step()
+    phase = profiler.mark("schedule.step", phase)
+
+RandomModel.step calls profiler.step_done() at its end.
+
+Both return 0, and step_done() does nothing, unless PROFILE_TRACE=path is
+set when the module is imported. Then the spans of the PROFILE_STEPS steps
+(10 by default) after the first PROFILE_SKIP ones are written to path as a
+Chrome trace (chrome://tracing, ui.perfetto.dev) and their per-phase totals
+are printed.
+
+This is the part of AgentsVisualization/Server/Profiler.py that this example
+uses, so it runs without the warehouse server next to it. The boids app and
+the two mesa examples share the same code after this docstring;
+AgentsVisualization/Server/tests/test_vendored.py fails while they differ.
+
+Solution to the situational problem TC2008B August-December 2021
+"""
+
+import json
+import os
+from time import perf_counter_ns
+
+class Profiler:
+    """
+    Per-phase totals and spans of the traced steps.
+    Attributes:
+        trace_path: Where the trace is written; None keeps the profiler disabled
+        trace_from, trace_steps: The steps trace_from to trace_from + trace_steps - 1 are traced
+        steps: Steps done so far
+        tracing: True while the current step is traced; clock and mark are no-ops otherwise
+        totals: Dictionary from phase name to [count, total nanoseconds] in the traced steps
+        events: (name, start, end) of the traced spans, in nanoseconds
+    """
+    def __init__(self, trace_path = None, trace_steps = 10, trace_from = 0):
+        self.trace_path = trace_path
+        self.trace_from = trace_from
+        self.trace_steps = trace_steps
+        self.steps = 0
+        self.tracing = trace_path is not None and trace_from == 0 and trace_steps > 0
+        self.totals = {}
+        self.events = []
+
+    def clock(self):
+        '''Start of a phase, 0 while not tracing.'''
+        if not self.tracing:
+            return 0
+        return perf_counter_ns()
+
+    def mark(self, name, start):
+        '''Ends the phase name that started at start and returns the start of the next one.'''
+        if not self.tracing:
+            return 0
+        now = perf_counter_ns()
+        # A start taken before the trace window
+        if not start:
+            return now
+        total = self.totals.setdefault(name, [0, 0])
+        total[0] += 1
+        total[1] += now - start
+        self.events.append((name, start, now))
+        return now
+
+    def step_done(self):
+        '''Moves the trace window at the end of every step, and writes the trace when it ends.'''
+        if self.trace_path is None:
+            return
+        self.steps += 1
+        end = self.trace_from + self.trace_steps
+        self.tracing = self.trace_from <= self.steps < end
+        if self.steps == end:
+            self.export_trace(self.trace_path)
+            print(self.report())
+
+    def report(self):
+        lines = [f"{'phase':<32} {'count':>9} {'total (ms)':>11}"]
+        for name, (count, total) in sorted(self.totals.items(), key = lambda item: item[1][1], reverse = True):
+            lines.append(f"{name:<32} {count:>9} {total / 1e6:>11.2f}")
+        return "\n".join(lines)
+
+    def export_trace(self, path):
+        '''Writes the spans as a Chrome trace; times are in microseconds from the first span.'''
+        origin = min((start for _, start, _ in self.events), default = 0)
+        events = [{"name": name, "cat": name.split(".")[0], "ph": "X", "pid": os.getpid(), "tid": 0,
+                   "ts": (start - origin) / 1e3, "dur": (end - start) / 1e3}
+                  for name, start, end in self.events]
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+# Shared by the whole process; set PROFILE_TRACE to enable it
+profiler = Profiler(os.environ.get("PROFILE_TRACE") or None, int(os.environ.get("PROFILE_STEPS", 10)),
+                    int(os.environ.get("PROFILE_SKIP", 0)))